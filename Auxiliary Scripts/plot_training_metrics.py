@@ -0,0 +1,79 @@
+import argparse
+import json
+
+
+def read_records(file_name):
+	"""
+	Reads the json lines written by training_metrics.MetricsLogger, e.g. parameter_checkpoints/training_metrics.jsonl
+	"""
+	with open(file_name) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+
+def print_epochs(records):
+	"""
+	Prints one line per epoch: throughput, share of the time spent waiting for batches, reconstruction error, free
+	energy and weight norm, followed by whether the run was limited by its input pipeline or by the updates
+	"""
+	for record in records:
+		if record["type"] == "start":
+			print "{} sections, batch size {}, {} processors ({})".format(record.get("sections"),
+				record.get("batch_size"), record["cpu_count"], record["platform"])
+	epochs = [r for r in records if r["type"] == "epoch"]
+	print "{:>5} {:>10} {:>6} {:>12} {:>12} {:>8}".format("epoch", "examples/s", "data", "recon error",
+														   "free energy", "|W|")
+	for r in epochs:
+		print "{:>5} {:>10.1f} {:>5.0%} {:>12.5f} {:>12.2f} {:>8.2f}".format(r["epoch"], r["examples_per_second"] or 0,
+			r["data_fraction"] or 0, r.get("reconstruction_error", float("nan")), r.get("free_energy", float("nan")),
+			r.get("W_norm", float("nan")))
+	validations = [r for r in records if r["type"] == "validation"]
+	if validations:
+		print "{:>5} {:>12} {:>12} {:>10}".format("epoch", "held-out err", "F gap", "best epoch")
+		for r in validations:
+			print "{:>5} {:>12.5f} {:>12.2f} {:>10}".format(r["epoch"], r["validation_reconstruction_error"],
+				r["free_energy_gap"], r["best_epoch"])
+	if epochs:
+		data = sum(r["data_seconds"] for r in epochs)
+		run = sum(r["run_seconds"] for r in epochs)
+		if data + run > 0:
+			print "{:.0%} of the time waiting for batches: {}".format(data/(data + run),
+				"data-bound" if data > run else "compute-bound")
+
+
+def plot(records):
+	"""
+	Plots the throughput and data fraction of every "updates" record, and the reconstruction error, free energy and
+	weight norm of every epoch
+	"""
+	import matplotlib.pyplot as plt
+	updates = [r for r in records if r["type"] == "updates"]
+	epochs = [r for r in records if r["type"] == "epoch" and "reconstruction_error" in r]
+
+	fig, axes = plt.subplots(2, 2)
+	axes[0][0].plot([r["update"] for r in updates], [r["examples_per_second"] for r in updates])
+	axes[0][0].set_title("examples per second")
+	axes[0][1].plot([r["update"] for r in updates], [r["data_fraction"] for r in updates])
+	axes[0][1].set_title("fraction of time waiting for batches")
+	validations = [r for r in records if r["type"] == "validation"]
+	axes[1][0].plot([r["epoch"] for r in epochs], [r["reconstruction_error"] for r in epochs], label="training")
+	axes[1][0].plot([r["epoch"] for r in validations], [r["validation_reconstruction_error"] for r in validations],
+					label="held out")
+	axes[1][0].legend()
+	axes[1][0].set_title("reconstruction error")
+	axes[1][1].plot([r["epoch"] for r in epochs], [r["free_energy"] for r in epochs], label="free energy")
+	axes[1][1].plot([r["epoch"] for r in epochs], [r["W_norm"] for r in epochs], label="|W|")
+	axes[1][1].legend()
+	plt.show()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("metrics", help="Metrics written by training.py", type=str, nargs="?",
+						default="parameter_checkpoints/training_metrics.jsonl")
+	parser.add_argument("--plot", help="Plot the metrics", action="store_true")
+	args = parser.parse_args()
+
+	records = read_records(args.metrics)
+	print_epochs(records)
+	if args.plot:
+		plot(records)
@@ -0,0 +1,256 @@
+import glob
+import json
+import os
+import numpy as np
+import midi_manipulation
+import song_stream
+
+
+class ChunkDataset(object):
+    """
+    Every section of num_timesteps of a training corpus, stored contiguously on disk and memory-mapped. The play and
+    articulate columns are stored as packed bits in notes.bin (sections x num_timesteps x bytes per timestep) and the
+    emotion values as float32 in emotions.bin (sections x num_timesteps x 2). Batches are expanded into the RBM's
+    float32 visible vectors by indexing, so after the dataset is built no song has to be parsed or reshaped again.
+    """
+
+    def __init__(self, dataset_dir):
+        """
+        :param dataset_dir: folder written by build_chunk_dataset
+        :type dataset_dir: str
+        """
+        with open(os.path.join(dataset_dir, "info.json")) as f:
+            self.info = json.load(f)
+        sections = self.info["sections"]
+        num_timesteps = self.info["num_timesteps"]
+        num_notes = self.info["num_notes"]
+        self.num_notes = num_notes
+        self.num_timesteps = num_timesteps
+        self.notes = np.memmap(os.path.join(dataset_dir, "notes.bin"), dtype=np.uint8, mode='r',
+                               shape=(sections, num_timesteps, (num_notes + 7) // 8))
+        self.emotions = np.memmap(os.path.join(dataset_dir, "emotions.bin"), dtype=np.float32, mode='r',
+                                  shape=(sections, num_timesteps, 2))
+
+    def __len__(self):
+        return self.info["sections"]
+
+    @property
+    def n_visible(self):
+        return self.num_timesteps*(self.num_notes + 2)
+
+    def batch(self, indices):
+        """
+        Expands the given sections into visible vectors.
+
+        :param indices: indices of the sections
+        :type indices: numpy array of int
+        :returns: matrix of sections x n_visible
+        :rtype: numpy array of float32
+        """
+        indices = np.sort(indices) # reading the memmaps in order keeps disk access sequential
+        batch = np.empty((len(indices), self.num_timesteps, self.num_notes + 2), dtype=np.float32)
+        batch[:, :, :-2] = np.unpackbits(self.notes[indices], axis=2)[:, :, :self.num_notes]
+        batch[:, :, -2:] = self.emotions[indices]
+        return np.reshape(batch, (len(indices), self.n_visible))
+
+    def split(self, validation_fraction=0.1, seed=0):
+        """
+        Splits the sections into a training set and a held-out validation set. Whole songs are held out, so no song
+        has sections on both sides, unless the dataset was built without recording its songs.
+
+        :param validation_fraction: fraction of the sections held out, by default 0.1
+        :param seed: seed choosing the songs held out, by default 0 (the same split every time)
+        :type validation_fraction: float
+        :type seed: int
+        :returns: indices of the training and validation sections
+        :rtype: tuple of numpy arrays of int
+        """
+        rng = np.random.RandomState(seed)
+        song_sections = self.info.get("song_sections") or [1]*len(self)
+        starts = np.cumsum([0] + song_sections[:-1])
+        validation = []
+        for song in rng.permutation(len(song_sections)):
+            if len(validation) >= validation_fraction*len(self):
+                break
+            validation.extend(range(starts[song], starts[song] + song_sections[song]))
+        validation = np.sort(np.array(validation, dtype=int))
+        return np.setdiff1d(np.arange(len(self)), validation), validation
+
+    def batches(self, batch_size, rng=np.random, indices=None):
+        """
+        Yields the sections in shuffled order, batch_size at a time. Call once per epoch.
+
+        :param batch_size: number of sections per batch, the last batch may be smaller
+        :param rng: random number generator, by default numpy's global one
+        :param indices: sections to draw from, by default all of them
+        :type batch_size: int
+        :type rng: numpy RandomState
+        :type indices: numpy array of int
+        :returns: generator over matrices of batch x n_visible
+        :rtype: generator
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        order = rng.permutation(indices)
+        for start in range(0, len(order), batch_size):
+            yield self.batch(order[start:start+batch_size])
+
+    def prefetched_batches(self, batch_size, rng=np.random, indices=None, buffer_size=4, workers=1, max_shift=0):
+        """
+        Yields the same batches as batches, expanded (and augmented, see transposed) by background threads while the
+        caller runs its updates (see song_stream.prefetched). The order of the sections and the shifts are drawn
+        from rng by the caller's thread, so a seeded run gets the same batches whatever the number of threads.
+
+        :param batch_size: number of sections per batch, the last batch may be smaller
+        :param rng: random number generator, by default numpy's global one
+        :param indices: sections to draw from, by default all of them
+        :param buffer_size: number of batches prepared ahead of the caller, 0 to prepare each one when it is needed
+        :param workers: number of threads preparing batches, by default 1
+        :param max_shift: largest number of semitones the sections are randomly transposed by, by default 0
+        :type batch_size: int
+        :type rng: numpy RandomState
+        :type indices: numpy array of int
+        :type buffer_size: int
+        :type workers: int
+        :type max_shift: int
+        :returns: generator over matrices of batch x n_visible
+        :rtype: generator
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        order = rng.permutation(indices)
+        jobs = []
+        for start in range(0, len(order), batch_size):
+            section_indices = order[start:start+batch_size]
+            # batch sorts its sections, the shifts are drawn in the same order
+            shifts = rng.randint(-max_shift, max_shift + 1, len(section_indices)) if max_shift else None
+            jobs.append((section_indices, shifts))
+
+        def prepare(job):
+            section_indices, shifts = job
+            batch = self.batch(section_indices)
+            if shifts is not None:
+                batch = transposed(batch, self.num_timesteps, self.num_notes, shifts)
+            return batch
+
+        return song_stream.prefetched(jobs, prepare, buffer_size, workers)
+
+
+def transposed(batch, num_timesteps, num_notes, shifts):
+    """
+    Transposes each section of a batch by its own number of semitones, moving both the play and the articulate
+    columns. Notes moved outside the pitch range are dropped; the emotion values are unchanged.
+
+    :param batch: matrix of sections x n_visible, as returned by ChunkDataset.batch
+    :param num_timesteps: number of timesteps per section
+    :param num_notes: number of note columns per timestep (play and articulate, 2*span)
+    :param shifts: number of semitones to move each section up by, negative to move it down
+    :type batch: numpy array
+    :type num_timesteps: int
+    :type num_notes: int
+    :type shifts: numpy array of int
+    :returns: matrix of sections x n_visible
+    :rtype: numpy array of float32
+    """
+    span = num_notes // 2
+    sections = np.reshape(batch, (len(batch), num_timesteps, num_notes + 2))
+    result = np.zeros_like(sections)
+    result[:, :, -2:] = sections[:, :, -2:]
+    for shift in np.unique(shifts):
+        rows = np.nonzero(shifts == shift)[0]
+        low, high = max(shift, 0), span + min(shift, 0) # columns of the transposed notes within each block
+        for block in (0, span):
+            result[rows, :, block+low:block+high] = sections[rows, :, block+low-shift:block+high-shift]
+    return np.reshape(result, batch.shape)
+
+
+def corpus_keys(path):
+    """
+    Returns the cache keys (see midi_manipulation.song_cache_key) of the midi files in a folder, which identify the
+    contents of the corpus. Files without an emotion text file are left out.
+
+    :param path: path to a folder containing midi files
+    :type path: str
+    :returns: cache key of each midi file, by file name
+    :rtype: dict
+    """
+    keys = {}
+    for midifile in sorted(glob.glob('{}/*.mid*'.format(path))):
+        if os.path.exists(midi_manipulation.emotion_text_file(midifile)):
+            keys[os.path.basename(midifile)] = midi_manipulation.song_cache_key(midifile)
+    return keys
+
+
+def build_chunk_dataset(path, dataset_dir, num_timesteps, cache_dir=None, workers=1, min_timesteps=50):
+    """
+    Splits every song of a folder of midi files into sections of num_timesteps and writes them to a ChunkDataset.
+    Songs are streamed one at a time (see song_stream.SongStream), so memory use does not depend on the size of the
+    corpus.
+
+    :param path: path to a folder containing midi files and their emotion text files
+    :param dataset_dir: folder to write the dataset to
+    :param num_timesteps: number of timesteps per section
+    :param cache_dir: folder holding preprocessed songs, by default no cache
+    :param workers: number of processes transforming files in parallel, by default 1
+    :param min_timesteps: songs with this many timesteps or fewer are left out, by default 50
+    :type path: str
+    :type dataset_dir: str
+    :type num_timesteps: int
+    :type cache_dir: str
+    :type workers: int
+    :type min_timesteps: int
+    :returns: the dataset
+    :rtype: ChunkDataset
+    """
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+    info_file = os.path.join(dataset_dir, "info.json")
+    if os.path.exists(info_file):
+        os.remove(info_file) # the dataset is incomplete until info.json is written again
+
+    sections = 0
+    song_sections = []
+    num_notes = 2*midi_manipulation.span
+    with song_stream.SongStream(path, cache_dir=cache_dir, workers=workers, min_timesteps=min_timesteps) as songs, \
+            open(os.path.join(dataset_dir, "notes.bin"), 'wb') as notes_file, \
+            open(os.path.join(dataset_dir, "emotions.bin"), 'wb') as emotions_file:
+        for song in songs:
+            rows = len(song) // num_timesteps
+            notes_file.write(np.ascontiguousarray(song.notes[:rows*num_timesteps]).tobytes())
+            emotions_file.write(np.ascontiguousarray(song.emotions[:rows*num_timesteps]).tobytes())
+            num_notes = song.num_notes
+            sections += rows
+            if rows:
+                song_sections.append(rows)
+    if sections == 0:
+        raise ValueError("{} holds no songs of at least {} timesteps".format(path, num_timesteps))
+
+    info = {
+        "sections": sections,
+        "song_sections": song_sections,
+        "num_timesteps": num_timesteps,
+        "num_notes": num_notes,
+        "min_timesteps": min_timesteps,
+        "corpus": corpus_keys(path),
+    }
+    with open(info_file, 'w') as f:
+        json.dump(info, f, indent=1, sort_keys=True)
+    return ChunkDataset(dataset_dir)
+
+
+def load_chunk_dataset(path, dataset_dir, num_timesteps, cache_dir=None, workers=1, min_timesteps=50):
+    """
+    Returns the ChunkDataset of a folder of midi files, building it first if it does not exist yet or if files were
+    added, changed or removed since it was built. Takes the same arguments as build_chunk_dataset.
+
+    :returns: the dataset
+    :rtype: ChunkDataset
+    """
+    info_file = os.path.join(dataset_dir, "info.json")
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            info = json.load(f)
+        if (info["num_timesteps"] == num_timesteps and info["min_timesteps"] == min_timesteps
+                and info["corpus"] == corpus_keys(path)):
+            return ChunkDataset(dataset_dir)
+    return build_chunk_dataset(path, dataset_dir, num_timesteps, cache_dir, workers, min_timesteps)
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class CompactSong(object):
+    """
+    Memory efficient container for a song matrix (see midi_manipulation.get_song). The play and articulate columns
+    only hold 0s and 1s, so they are stored as packed bits (one byte per 8 notes), and the emotion values are stored
+    separately as float32. A timestep of 2*78 notes + 2 emotions takes 28 bytes instead of 1264 as a float64 row.
+    The float32 matrix fed to the RBM is only expanded when asked for.
+    """
+
+    def __init__(self, notes, emotions, num_notes):
+        """
+        :param notes: packed bits of the play and articulate columns, one row per timestep
+        :param emotions: arousal and valence values, one row per timestep
+        :param num_notes: number of play and articulate columns before packing (2*span)
+        :type notes: numpy array of uint8
+        :type emotions: numpy array of float32
+        :type num_notes: int
+        """
+        self.notes = notes
+        self.emotions = emotions
+        self.num_notes = num_notes
+
+    @classmethod
+    def from_matrix(cls, song):
+        """
+        Packs a song matrix whose last two columns are the emotion values.
+
+        :param song: matrix of timesteps x (2*span+2)
+        :type song: numpy array
+        :returns: packed song
+        :rtype: CompactSong
+        """
+        song = np.asarray(song)
+        notes = np.packbits(song[:, :-2].astype(np.uint8), axis=1)
+        emotions = song[:, -2:].astype(np.float32)
+        return cls(notes, emotions, song.shape[1] - 2)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Reads a song written with save.
+
+        :param file_name: path to .npz file
+        :type file_name: str
+        :returns: packed song
+        :rtype: CompactSong
+        """
+        stored = np.load(file_name)
+        return cls(stored["notes"], stored["emotions"], int(stored["num_notes"]))
+
+    def save(self, f):
+        """
+        Writes the packed song to a compressed .npz file.
+
+        :param f: path or open file
+        :type f: str or file
+        :returns: None
+        :rtype: None
+        """
+        np.savez_compressed(f, notes=self.notes, emotions=self.emotions, num_notes=self.num_notes)
+
+    def __len__(self):
+        return len(self.emotions)
+
+    @property
+    def shape(self):
+        return len(self), self.num_notes + 2
+
+    @property
+    def nbytes(self):
+        return self.notes.nbytes + self.emotions.nbytes
+
+    def to_matrix(self, dtype=np.float32):
+        """
+        Expands the packed song back into a matrix of timesteps x (2*span+2).
+
+        :param dtype: type of the returned matrix, by default float32
+        :type dtype: numpy dtype
+        :returns: song matrix
+        :rtype: numpy array
+        """
+        song = np.empty(self.shape, dtype=dtype)
+        song[:, :-2] = np.unpackbits(self.notes, axis=1)[:, :self.num_notes]
+        song[:, -2:] = self.emotions
+        return song
+
+    def chunks(self, num_timesteps, dtype=np.float32):
+        """
+        Splits the song into consecutive sections of num_timesteps, each flattened into one visible vector of the RBM.
+        Timesteps left over at the end are dropped.
+
+        :param num_timesteps: number of timesteps per section
+        :param dtype: type of the returned matrix, by default float32
+        :type num_timesteps: int
+        :type dtype: numpy dtype
+        :returns: matrix of sections x (num_timesteps*(2*span+2))
+        :rtype: numpy array
+        """
+        rows = len(self) // num_timesteps
+        song = self.to_matrix(dtype)[:rows*num_timesteps]
+        return np.reshape(song, [rows, song.shape[1]*num_timesteps])
@@ -9,8 +9,14 @@ from tqdm import tqdm
 
 
 num_timesteps = rbm.num_timesteps
+note_range = midi_manipulation.span
 x, emotions, W, bh, bv = rbm.get_variables()
 
+# 0 for the emotion elements of the visible layer, 1 for the notes
+note_mask = np.ones((1, rbm.n_visible), np.float32)
+note_mask[0, rbm.emotion_columns()] = 0
+note_mask = tf.constant(note_mask)
+
 def sample(probs):
 	"""
 	Given a vector of probabilities, each element is added to a random value between 0 and 1, and then 
@@ -29,7 +35,9 @@ def sample_correct(probs, emotions):
 	Given a vector of probabilities, each element is added to a random value between 0 and 1, and then 
 	rounded down to give a value of either 0 or 1. Higher input probabilities have a higher chance of being 1.
 
-	In addition to sampling, the emotion values are clamped to the last two elements of each timestep.
+	In addition to sampling, the emotion values are clamped to the last two elements of each timestep. Each line of
+	emotion values covers 16 consecutive timesteps. Clamping is done with a fixed mask over the emotion elements, so
+	it costs a few element-wise operations whatever the number of timesteps.
 
 	:param probs: vector of probablities
 	:param emotions: vector of 8 emotion values (4 arousal, 4 valence)
@@ -38,19 +46,13 @@ def sample_correct(probs, emotions):
 	:returns: vector of 0s and 1s sampled from the input vector
 	:rtype: tensor
 	"""
-	notes = tf.floor(probs + tf.random_uniform(tf.shape(probs), 0, 1))[0]
-	notes = tf.unpack(notes)
-	emotions = tf.unpack(emotions)
-	for i in range(16):
-		j=156
-		e = i / 4 * 2
-		notes[j] = emotions[e]
-		notes[j+1] = emotions[e+1]
-		j += 158
-	notes = tf.pack(notes)
-	final = tf.cast(notes, tf.float32)
-	trans = tf.reshape(final, [1, 10112])
-	return trans
+	notes = tf.floor(probs + tf.random_uniform(tf.shape(probs), 0, 1))
+	# expand the emotion values to one (arousal, valence) pair per timestep, placed after the notes of each timestep
+	emotions = tf.tile(tf.reshape(emotions, [-1, 1, 2]), [1, rbm.emotion_timesteps, 1])
+	emotions = tf.pad(tf.reshape(emotions, [num_timesteps, 2]), [[0, 0], [2*note_range, 0]])
+	emotions = tf.reshape(emotions, [1, rbm.n_visible])
+	final = notes*note_mask + emotions
+	return final
 
 
 def gibbs_sample_generate(k):
@@ -88,6 +90,24 @@ def gibbs_sample_generate(k):
 	return x_sample
 
 
+gibbs_samplers = {} # Sampling graph for each number of gibbs steps, built once and reused for every segment
+
+def get_gibbs_sampler(k):
+	"""
+	Returns the k-step gibbs chain of gibbs_sample_generate, building it the first time it is asked for. The chain
+	reads the visible state from x and the emotion values from emotions, so the same graph is run for every segment
+	instead of adding a new chain to the graph each time.
+
+	:params k: number of gibbs step iterations to run
+	:type k: int
+	:returns: matrix of music sampled
+	:rtype: tensor
+	"""
+	if k not in gibbs_samplers:
+		gibbs_samplers[k] = gibbs_sample_generate(k)
+	return gibbs_samplers[k]
+
+
 def generate_music(emotion_text_file, midi_file_name):
 	"""
 	Given a series of emotion data points, the function will generate music that corresponds
@@ -115,6 +135,7 @@ def generate_music(emotion_text_file, midi_file_name):
 		saver.restore(sess, saved_weights_path) # load the saved weights and biases of the model
 		
 		text = open(emotion_text_file, 'r')		# open text file with emotion values
+		writer = midi_manipulation.StreamingMidiWriter(midi_file_name) # midi file the music is saved to
 		x_ = np.zeros((1, n_visible))
 		j=156
 		emotions_ = np.array([])
@@ -138,16 +159,12 @@ def generate_music(emotion_text_file, midi_file_name):
 			if l%4==3:
 				# first 12 measures run gibbs chain 5 times, due to sparse notes played otherwise
 				if l < 13:
-					sample = gibbs_sample_generate(5).eval(session=sess, feed_dict={x: x_, emotions: emotions_})
+					sample = get_gibbs_sampler(5).eval(session=sess, feed_dict={x: x_, emotions: emotions_})
 				else:
-					sample = gibbs_sample_generate(1).eval(session=sess, feed_dict={x: x_, emotions: emotions_})
+					sample = get_gibbs_sampler(1).eval(session=sess, feed_dict={x: x_, emotions: emotions_})
 
-				# reshape the vector to be timesteps x notes (64x158), and then keep adding into one final matrix (song) 
-				if 'song' in locals():
-					S = np.reshape(sample, (num_timesteps, (2*note_range+2)))
-					song = np.concatenate((song, S), axis=0)
-				else:
-					song = np.reshape(sample, (num_timesteps, (2*note_range+2)))
+				# reshape the vector to be timesteps x notes (64x158), and append it to the midi file
+				writer.write(np.reshape(sample, (num_timesteps, (2*note_range+2))))
 				
 				# matrix returned from sample is the input into the next segment of 64 timesteps
 				x_ = np.reshape(sample, (1, n_visible))
@@ -155,6 +172,6 @@ def generate_music(emotion_text_file, midi_file_name):
 				emotions_ = np.array([])
 				j=156
 
-		# save the matrix as a midi file
-		midi_manipulation.noteStateMatrixToMidi(song, midi_file_name)
+		# finish the midi file
+		writer.close()
 	return
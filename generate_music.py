@@ -16,8 +16,11 @@ def main():
 	This method is run through the command-line interface
 	:param video_path: path to video file from current location
 	:param generator_opt: music generator option: 1 (Scales), 2 (Chords), 3 (RBM)
+	:param server: port of a running generation server (generation_server.py) used for the RBM options, by default
+				   the model is loaded by this process
 	:type video_path: str
 	:type generator_opt: int
+	:type server: int
 	:returns: None
 	:rtype: None
 	"""
@@ -29,6 +32,9 @@ def main():
 	parser.add_argument("generator_opt", help="Music generator option: 1 (Scales), 2 (Chords), 3 (RBM - Feedback), 4 (RBM - Sampling)",
                     	type=int)
 
+	parser.add_argument("--server", help="Port of a running generation server to use for the RBM options",
+						type=int, default=None)
+
 	args = parser.parse_args()
 
 	generator_option = args.generator_opt
@@ -50,14 +56,25 @@ def main():
 			combined_emotions.video_to_emotion_as_file(videofile, multiple=24)
 			print "Generating music!"
 			chords.create_arpeggios_chord_variation(emotion_text_file, file_name)
-		if generator_option == 3:
+		if generator_option in [3,4] and args.server is not None:
+			import generation_server
+			import midi_manipulation
+			# RBM generated music, from a generation server that already holds the trained model
+			print "Analysing video and extracting emotion values"
+			combined_emotions.video_to_emotion_as_file(videofile)
+			print "Generating music!"
+			mode = "feedback" if generator_option == 3 else "sampling"
+			emotions = midi_manipulation.read_emotions(emotion_text_file).tolist()
+			with open(file_name + '.mid', 'wb') as midi_file:
+				midi_file.write(generation_server.request_music(emotions, mode, port=args.server))
+		elif generator_option == 3:
 			import generate_feedback
 			# RBM (feedback) generated music
 			print "Analysing video and extracting emotion values"
 			combined_emotions.video_to_emotion_as_file(videofile)
 			print "Generating music!"
 			generate_feedback.generate_music(emotion_text_file, file_name)
-		if generator_option == 4:
+		elif generator_option == 4:
 			import generate_sampling
 			# RBM (sampling) generated music
 			print "Analysing video and extracting emotion values"
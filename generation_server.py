@@ -0,0 +1,221 @@
+import argparse
+import httplib
+import json
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+import numpy as np
+import midi
+import midi_manipulation
+import rbm
+import rbm_generation
+
+
+class GenerationJob(object):
+	"""
+	A generation request waiting in the server's queue. The request handler waits on done until a worker thread has
+	filled in either midi (the bytes of the midi file) or error.
+	"""
+
+	def __init__(self, emotions, mode, k, seed):
+		self.emotions = emotions
+		self.mode = mode
+		self.k = k
+		self.seed = seed
+		self.midi = None
+		self.error = None
+		self.done = threading.Event()
+
+
+class GenerationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""
+	Local HTTP server holding a trained RBM in memory, so generation requests do not pay for loading TensorFlow and
+	restoring the model. Each connection is handled in its own thread and puts its request in a bounded queue, from
+	which a fixed number of worker threads generate the music. Requests are refused while the queue is full.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, address, model, workers=2, queue_size=16, cache=None):
+		"""
+		:param address: host and port to listen on
+		:param model: trained RBM
+		:param workers: number of requests generated at the same time, by default 2
+		:param queue_size: number of requests that can wait for a worker, by default 16
+		:param cache: cache of generated segments used by requests with a seed, by default none
+		:type address: tuple
+		:type model: rbm.NumpyRBM
+		:type workers: int
+		:type queue_size: int
+		:type cache: rbm_generation.SegmentCache
+		"""
+		BaseHTTPServer.HTTPServer.__init__(self, address, GenerationRequestHandler)
+		self.model = model
+		self.model_key = rbm_generation.model_hash(model) # the weights never change, so they are hashed only once
+		self.cache = cache
+		self.jobs = Queue.Queue(queue_size)
+		self.workers = [threading.Thread(target=self.work) for _ in range(workers)]
+		for worker in self.workers:
+			worker.daemon = True
+			worker.start()
+
+	def work(self):
+		"""
+		Generates the music of queued requests, one at a time, for as long as the server runs.
+
+		:returns: None
+		:rtype: None
+		"""
+		while True:
+			job = self.jobs.get()
+			try:
+				job.midi = self.generate(job)
+			except Exception as e:
+				job.error = "{}: {}".format(type(e).__name__, e)
+			job.done.set()
+			self.jobs.task_done()
+
+	def generate(self, job):
+		"""
+		Generates the music of a request and returns it as the bytes of a midi file. Every request samples with its
+		own random number generator, so requests with a seed are reproducible whatever else the server is running.
+		Requests with a seed are generated deterministically, through the segment cache if the server has one.
+
+		:param job: generation request
+		:type job: GenerationJob
+		:returns: midi file
+		:rtype: str
+		"""
+		model = rbm.NumpyRBM(self.model.W, self.model.bh, self.model.bv, job.seed) # shares the weights
+		segments = len(job.emotions) // rbm_generation.lines_per_segment
+		timeline = np.reshape(job.emotions[:segments*rbm_generation.lines_per_segment],
+							  (segments, rbm_generation.lines_per_segment, 2))
+		if job.seed is not None:
+			song = rbm_generation.generate_deterministic(model, timeline, job.mode, job.k, job.seed, self.cache,
+														 model_key=self.model_key)
+		else:
+			song = rbm_generation.generate_batch(model, [timeline], job.mode, job.k)[0]
+		f = StringIO()
+		midi.write_midifile(f, midi_manipulation.noteStateMatrixToPattern(song))
+		return f.getvalue()
+
+
+class GenerationRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	POST /generate with a json body {"emotions": [[arousal, valence], ...], "mode": "feedback" or "sampling",
+	"gibbs_steps": number of Gibbs steps per segment (optional), "seed": seed (optional)} returns the midi file.
+	GET /status returns the number of queued requests and worker threads as json.
+	"""
+
+	def send(self, code, body, content_type="application/json"):
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path != "/status":
+			self.send(404, json.dumps({"error": "unknown path"}))
+			return
+		status = {"queued": self.server.jobs.qsize(), "workers": len(self.server.workers)}
+		if self.server.cache is not None:
+			status.update({"cache_hits": self.server.cache.hits, "cache_misses": self.server.cache.misses})
+		self.send(200, json.dumps(status))
+
+	def do_POST(self):
+		if self.path != "/generate":
+			self.send(404, json.dumps({"error": "unknown path"}))
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+			emotions = np.array(request["emotions"], np.float32).reshape(-1, 2)
+			mode = request.get("mode", "feedback")
+			if mode not in rbm_generation.modes:
+				raise ValueError("unknown mode {}".format(mode))
+			job = GenerationJob(emotions, mode, request.get("gibbs_steps"), request.get("seed"))
+		except Exception as e:
+			self.send(400, json.dumps({"error": "{}: {}".format(type(e).__name__, e)}))
+			return
+
+		try:
+			self.server.jobs.put_nowait(job)
+		except Queue.Full:
+			self.send(503, json.dumps({"error": "too many requests queued"}))
+			return
+		job.done.wait()
+		if job.error is not None:
+			self.send(500, json.dumps({"error": job.error}))
+		else:
+			self.send(200, job.midi, "audio/midi")
+
+	def log_message(self, format, *args):
+		pass
+
+
+def request_music(emotions, mode="feedback", k=None, seed=None, host="127.0.0.1", port=8765):
+	"""
+	Asks a running generation server for music.
+
+	:param emotions: (arousal, valence) pairs, one per line of the emotion text file
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:param k: number of Gibbs steps for every segment, by default the steps of the mode
+	:param seed: seed of the random number generator, by default random
+	:param host: address of the server, by default 127.0.0.1
+	:param port: port of the server, by default 8765
+	:type emotions: list
+	:type mode: str
+	:type k: int
+	:type seed: int
+	:type host: str
+	:type port: int
+	:returns: midi file
+	:rtype: str
+	"""
+	body = json.dumps({"emotions": [list(map(float, e)) for e in emotions], "mode": mode,
+					   "gibbs_steps": k, "seed": seed})
+	connection = httplib.HTTPConnection(host, port)
+	connection.request("POST", "/generate", body, {"Content-Type": "application/json"})
+	response = connection.getresponse()
+	data = response.read()
+	connection.close()
+	if response.status != 200:
+		raise RuntimeError("Generation server returned {}: {}".format(response.status, data))
+	return data
+
+
+def main():
+	"""
+	Loads the trained model once and serves generation requests on localhost until interrupted.
+
+	This method is run through the command-line interface
+	:param model: path to the trained model, by default parameter_checkpoints/trained_system
+	:param port: port to listen on, by default 8765
+	:param workers: number of requests generated at the same time, by default 2
+	:param queue_size: number of requests that can wait for a worker, by default 16
+	:param cache_dir: folder of the segment cache, by default segments are only cached in memory
+	:returns: None
+	:rtype: None
+	"""
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--model", help="Trained model (.npz or TensorFlow checkpoint)", type=str,
+						default="parameter_checkpoints/trained_system")
+	parser.add_argument("--port", help="Port to listen on", type=int, default=8765)
+	parser.add_argument("--workers", help="Number of requests generated at the same time", type=int, default=2)
+	parser.add_argument("--queue-size", help="Number of requests that can wait for a worker", type=int, default=16)
+	parser.add_argument("--cache-dir", help="Folder of the segment cache", type=str, default=None)
+	args = parser.parse_args()
+
+	model = rbm_generation.load_model(args.model)
+	cache = rbm_generation.SegmentCache(cache_dir=args.cache_dir)
+	server = GenerationServer(("127.0.0.1", args.port), model, args.workers, args.queue_size, cache)
+	print "Serving music generation on 127.0.0.1:{}".format(args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+if __name__ == "__main__":
+	main()
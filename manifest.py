@@ -0,0 +1,208 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import midi
+import midi_manipulation
+
+
+def file_sha1(file_name):
+    """
+    Returns the sha1 digest of a file's contents
+
+    :param file_name: path to file
+    :type file_name: str
+    :returns: hexadecimal sha1 digest
+    :rtype: str
+    """
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def describe_midi(midifile):
+    """
+    Reads a midi file and its emotion text file, and returns the metadata stored for it in the manifest:
+    content hashes, sizes and modification times of both files, number of emotion values, resolution,
+    number of tracks, length in ticks, time signatures in order of appearance, number of timesteps of the
+    note state matrix, and the average number of notes (within lowerBound and upperBound) playing per timestep.
+
+    :param midifile: path to midifile
+    :type midifile: str
+    :returns: metadata of the midi file
+    :rtype: dict
+    """
+    entry = {
+        "midi_sha1": file_sha1(midifile),
+        "midi_size": os.path.getsize(midifile),
+        "midi_mtime": os.path.getmtime(midifile),
+    }
+
+    text_file = midi_manipulation.emotion_text_file(midifile)
+    if os.path.exists(text_file):
+        with open(text_file) as f:
+            emotion_lines = sum(1 for line in f if line.strip())
+        entry.update({
+            "text_sha1": file_sha1(text_file),
+            "text_size": os.path.getsize(text_file),
+            "text_mtime": os.path.getmtime(text_file),
+            "emotion_lines": emotion_lines,
+        })
+    else:
+        entry.update({"text_sha1": None, "text_size": None, "text_mtime": None, "emotion_lines": 0})
+
+    try:
+        pattern = midi.read_midifile(midifile)
+        ticks = 0
+        time_signatures = []
+        for track in pattern:
+            time = 0
+            for evt in track:
+                time += evt.tick
+                if isinstance(evt, midi.TimeSignatureEvent):
+                    time_signatures.append((time, "{}/{}".format(evt.numerator, evt.denominator)))
+            ticks = max(ticks, time)
+        statematrix = midi_manipulation.patternToNoteStateMatrix(pattern)
+        entry.update({
+            "resolution": pattern.resolution,
+            "tracks": len(pattern),
+            "ticks": ticks,
+            "time_signatures": [signature for _, signature in sorted(time_signatures)],
+            "timesteps": statematrix.shape[0],
+            "note_density": float(statematrix[:, :midi_manipulation.span].sum(axis=1).mean()),
+            "error": None,
+        })
+    except Exception as e:
+        entry["error"] = "{}: {}".format(type(e).__name__, e)
+    return entry
+
+
+def is_unchanged(entry, midifile):
+    """
+    Checks whether a midi file and its emotion text file have the same size and modification time as when the
+    manifest entry was made.
+
+    :param entry: metadata of the midi file (see describe_midi)
+    :param midifile: path to midifile
+    :type entry: dict
+    :type midifile: str
+    :returns: True if neither file changed
+    :rtype: bool
+    """
+    text_file = midi_manipulation.emotion_text_file(midifile)
+    if os.path.exists(text_file):
+        text_stat = (os.path.getsize(text_file), os.path.getmtime(text_file))
+    else:
+        text_stat = (None, None)
+    return ((entry["midi_size"], entry["midi_mtime"]) == (os.path.getsize(midifile), os.path.getmtime(midifile))
+            and (entry["text_size"], entry["text_mtime"]) == text_stat)
+
+
+def build_manifest(path, manifest_file=None):
+    """
+    Creates or updates the manifest of a folder of midi files: a json index holding the metadata of every midi file
+    (see describe_midi). Only files that were added or changed since the manifest was last written are read, and
+    files that were removed are dropped from it.
+
+    :param path: path to a folder containing midi files
+    :param manifest_file: path to the manifest, by default manifest.json in the folder
+    :type path: str
+    :type manifest_file: str
+    :returns: manifest, holding the converter version and the metadata of each file by file name
+    :rtype: dict
+    """
+    if manifest_file is None:
+        manifest_file = os.path.join(path, "manifest.json")
+    manifest = load_manifest(manifest_file)
+    if manifest.get("converter_version") != midi_manipulation.converterVersion:
+        manifest = {"converter_version": midi_manipulation.converterVersion, "files": {}}
+
+    entries = {}
+    for midifile in sorted(glob.glob('{}/*.mid*'.format(path))):
+        name = os.path.basename(midifile)
+        entry = manifest["files"].get(name)
+        if entry is None or not is_unchanged(entry, midifile):
+            entry = describe_midi(midifile)
+        entries[name] = entry
+    manifest["files"] = entries
+
+    # write to a temporary file first so an interrupted run never leaves a truncated manifest behind
+    temp_file = "{}.{}.tmp".format(manifest_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(temp_file, manifest_file)
+    return manifest
+
+
+def load_manifest(manifest_file):
+    """
+    Reads a manifest written by build_manifest
+
+    :param manifest_file: path to the manifest
+    :type manifest_file: str
+    :returns: manifest, empty if the file does not exist
+    :rtype: dict
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def select(manifest, path, min_timesteps=50, numerators=midi_manipulation.timeSignatureNumerators,
+           require_emotions=True):
+    """
+    Returns the midi files of a manifest that meet the given conditions, without opening them.
+
+    :param manifest: manifest of the folder (see build_manifest)
+    :param path: path to the folder of the manifest
+    :param min_timesteps: files with this many timesteps or fewer are left out, by default 50
+    :param numerators: files with a time signature of any other numerator are left out, None to keep every meter.
+                       By default those the converter handles, 2 and 4 (midi_manipulation.timeSignatureNumerators)
+    :param require_emotions: leave out files without an emotion text file, by default True
+    :type manifest: dict
+    :type path: str
+    :type min_timesteps: int
+    :type numerators: tuple of int
+    :type require_emotions: bool
+    :returns: paths to the selected midi files
+    :rtype: list
+    """
+    files = []
+    for name, entry in sorted(manifest["files"].items()):
+        if entry["error"] is not None or entry["timesteps"] <= min_timesteps:
+            continue
+        if require_emotions and entry["emotion_lines"] == 0:
+            continue
+        if numerators is not None and any(int(signature.split("/")[0]) not in numerators
+                                          for signature in entry["time_signatures"]):
+            continue
+        files.append(os.path.join(path, name))
+    return files
+
+
+def main():
+    """
+    Builds or updates the manifest of a folder of midi files and prints a summary of it.
+
+    This method is run through the command-line interface
+    :param path: path to a folder containing midi files
+    :type path: str
+    :returns: None
+    :rtype: None
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Path to a folder containing midi files", type=str)
+    parser.add_argument("--manifest", help="Path to the manifest, by default manifest.json in the folder",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.path, args.manifest)
+    entries = manifest["files"].values()
+    print "{} midi files".format(len(entries))
+    print "{} could not be read".format(sum(1 for e in entries if e["error"] is not None))
+    print "{} have no emotion text file".format(sum(1 for e in entries if e["emotion_lines"] == 0))
+    print "{} selected for training".format(len(select(manifest, args.path)))
+
+if __name__ == "__main__":
+    main()
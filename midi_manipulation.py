@@ -2,66 +2,207 @@
 
 import midi
 import numpy as np
+import compact_song
 import glob
+import hashlib
+import multiprocessing
+import os
 from tqdm import tqdm
 
 lowerBound = 24
 upperBound = 102
 span = upperBound-lowerBound
 
+timeSignatureNumerators = (2, 4) # Time signatures the converter handles, it stops at any other one
+converterVersion = 3 # Increase whenever the song matrix format changes, so that cached songs are parsed again
 
-def get_songs(path):
+
+def get_songs(path, cache_dir=None, workers=1, chunksize=4, compact=False):
     """
     Iterates through all the midi files in a given folder, transforms each into a note state matrix, concatenates the
-    emotion values at the end of each timestep, and adds the final matrix to a list of songs
+    emotion values at the end of each timestep, and adds the final matrix to a list of songs. Files that cannot be
+    transformed are skipped and reported.
 
     :param path: path to a folder containing midi files used for training the model
+    :param cache_dir: folder holding preprocessed songs, only new or changed files are parsed. By default no cache
+    :param workers: number of processes transforming files in parallel, by default 1 (no process pool)
+    :param chunksize: number of files sent to a worker process at a time, by default 4
+    :param compact: return each song as a CompactSong instead of a matrix, by default False
     :type path: str 
-    :returns: list of all songs in matrix form
+    :type cache_dir: str
+    :type workers: int
+    :type chunksize: int
+    :type compact: bool
+    :returns: list of all songs in matrix form (or CompactSong form)
     :rtype: list
     """
     files = glob.glob('{}/*.mid*'.format(path))
+    jobs = [(f, cache_dir, compact) for f in files]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(load_song, jobs, chunksize)
+    else:
+        results = (load_song(job) for job in jobs)
+
     songs = []
-    for f in tqdm(files):
-        try:
-            song = np.array(midiToNoteStateMatrix(f))
-            x, y = song.shape
-            emotion_array = np.zeros((x,2))
-            i = 0
-            text_file = f.replace("mid", "txt")
-
-            # total number of emotion values in file. Following two lines of code taken from:
-            with open(text_file) as f:
-                total_lines = sum(1 for _ in f)
-
-            repeats = x/total_lines   # used to determine how many timesteps are assigned the same emotion values
-
-            text = open(text_file, 'r')     # required to reopen text file
-            for line in text:
-                emotion = line[:-1].split(",")
-                a = float(emotion[0])
-                v = float(emotion[1])
-                for j in range(repeats):
-                    emotion_array[i+j] = [a,v]
-                i += repeats
-
-            # add last emotion values to remaining timesteps
-            j += 1
-            i -= repeats
-            while i+j < x:
-                emotion_array[i+j] = [a,v]
-                j += 1
-
-            # add emotion values columns to the end of the song matrix
-            song = np.hstack((song, emotion_array))
-
-            if np.array(song).shape[0] > 50:
+    skipped = []
+    try:
+        for f, song, error in tqdm(results, total=len(jobs)):
+            if error is not None:
+                skipped.append((f, error))
+            elif len(song) > 50:
                 songs.append(song)
-        except Exception as e:
-            raise e           
+    finally:
+        # every result has been read unless the loop was interrupted, in which case the workers must not outlive it
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    for f, error in skipped:
+        print "Skipped {} ({})".format(f, error)
     return songs
 
 
+def load_song(job):
+    """
+    Transforms a single midi file for get_songs. Runs in a worker process when ingesting in parallel, so errors
+    are returned rather than raised.
+
+    :param job: path to midifile, cache folder (None for no cache) and whether to return a CompactSong
+    :type job: tuple
+    :returns: path to midifile, the song (None on failure) and error message (None on success)
+    :rtype: tuple
+    """
+    midifile, cache_dir, compact = job
+    try:
+        if cache_dir is not None:
+            song = get_cached_song(midifile, cache_dir, compact)
+        elif compact:
+            song = compact_song.CompactSong.from_matrix(get_song(midifile))
+        else:
+            song = get_song(midifile)
+    except Exception as e:
+        return midifile, None, "{}: {}".format(type(e).__name__, e)
+    return midifile, song, None
+
+
+def emotion_text_file(midifile):
+    """
+    Returns the path to the text file holding the emotion values of a midi file
+
+    :param midifile: path to midifile
+    :type midifile: str
+    :returns: path to emotion text file
+    :rtype: str
+    """
+    return midifile.replace("mid", "txt")
+
+
+def get_song(midifile):
+    """
+    Transforms a midi file into a note state matrix and concatenates the emotion values from its text file at the end
+    of each timestep.
+
+    :param midifile: path to midifile
+    :type midifile: str
+    :returns: matrix of timesteps x (2*span+2)
+    :rtype: numpy array of float32
+    """
+    song = midiToNoteStateMatrix(midifile)
+    emotions = read_emotions(emotion_text_file(midifile))
+
+    # add emotion values columns to the end of the song matrix
+    song = np.hstack((song, align_emotions(emotions, song.shape[0])))
+    return song
+
+
+def read_emotions(text_file):
+    """
+    Reads an emotion text file, holding one "arousal, valence" pair per line.
+
+    :param text_file: path to emotion text file
+    :type text_file: str
+    :returns: matrix of lines x 2
+    :rtype: numpy array of float32
+    """
+    with open(text_file) as f:
+        emotions = [line.split(",")[:2] for line in f if line.strip()]
+    if not emotions:
+        raise ValueError("{} holds no emotion values".format(text_file))
+    return np.array(emotions, dtype=np.float32)
+
+
+def align_emotions(emotions, timesteps):
+    """
+    Spreads emotion values over the timesteps of a song. Each emotion value is assigned to the same number of
+    consecutive timesteps (timesteps // number of emotion values), and timesteps left over at the end take the last
+    emotion value. If there are more emotion values than timesteps, each timestep takes one value and the values
+    past the end of the song are dropped.
+
+    :param emotions: matrix of emotion values x 2 (see read_emotions)
+    :param timesteps: number of timesteps in the song
+    :type emotions: numpy array
+    :type timesteps: int
+    :returns: matrix of timesteps x 2
+    :rtype: numpy array
+    """
+    repeats = max(timesteps // len(emotions), 1) # number of timesteps assigned the same emotion values
+    index = np.minimum(np.arange(timesteps) // repeats, len(emotions) - 1)
+    return emotions[index]
+
+
+def song_cache_key(midifile):
+    """
+    Returns a key identifying the preprocessed form of a midi file. It covers the contents of the midi file and its
+    emotion text file, the pitch range and the converter version, so a change in any of them gives a new key.
+
+    :param midifile: path to midifile
+    :type midifile: str
+    :returns: hexadecimal sha1 digest
+    :rtype: str
+    """
+    key = hashlib.sha1()
+    for file_name in (midifile, emotion_text_file(midifile)):
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        key.update(hashlib.sha1(content).digest())
+    key.update("{},{},{}".format(lowerBound, upperBound, converterVersion))
+    return key.hexdigest()
+
+
+def get_cached_song(midifile, cache_dir, compact=False):
+    """
+    Returns the song matrix of a midi file (see get_song), reading it from the cache folder if it has been
+    preprocessed before, and otherwise parsing it and storing the result. Songs are stored as CompactSongs in
+    compressed .npz files named after the cache key.
+
+    :param midifile: path to midifile
+    :param cache_dir: folder holding preprocessed songs
+    :param compact: return a CompactSong instead of a matrix, by default False
+    :type midifile: str
+    :type cache_dir: str
+    :type compact: bool
+    :returns: matrix of timesteps x (2*span+2) (or CompactSong)
+    :rtype: numpy array
+    """
+    cache_file = os.path.join(cache_dir, "{}.npz".format(song_cache_key(midifile)))
+    if os.path.exists(cache_file):
+        song = compact_song.CompactSong.load(cache_file)
+    else:
+        song = compact_song.CompactSong.from_matrix(get_song(midifile))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first so an interrupted run never leaves a truncated cache entry behind
+        temp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            song.save(f)
+        os.rename(temp_file, cache_file)
+
+    if compact:
+        return song
+    return song.to_matrix()
+
+
 def midiToNoteStateMatrix(midifile, span=span):
     """
     Reads a midi file, and transforms it into a note state matrix of size 2*span.
@@ -76,115 +217,264 @@ def midiToNoteStateMatrix(midifile, span=span):
     :rtype: numpy array
     """
     pattern = midi.read_midifile(midifile)
+    return patternToNoteStateMatrix(pattern, span)
 
-    timeleft = [track[0].tick for track in pattern]
-
-    posns = [0 for track in pattern]
-
-    statematrix = []
-    time = 0
-
-    state = [[0,0] for x in range(span)]
-    statematrix.append(state)
-    condition = True
-    while condition:
-        if time % (pattern.resolution / 4) == (pattern.resolution / 8):
-            # Crossed a note boundary. Create a new state, defaulting to holding notes
-            oldstate = state
-            state = [[oldstate[x][0],0] for x in range(span)]
-            statematrix.append(state)
-        for i in range(len(timeleft)): # For each track
-            if not condition:
-                break
-            while timeleft[i] == 0:
-                track = pattern[i]
-                pos = posns[i]
-
-                evt = track[pos]
-                if isinstance(evt, midi.NoteEvent):
-                    if (evt.pitch < lowerBound) or (evt.pitch >= upperBound):
-                        pass
-                    else:
-                        if isinstance(evt, midi.NoteOffEvent) or evt.velocity == 0:
-                            state[evt.pitch-lowerBound] = [0, 0]
-                        else:
-                            state[evt.pitch-lowerBound] = [1, 1]
-                elif isinstance(evt, midi.TimeSignatureEvent):
-                    if evt.numerator not in (2, 4):
-                        # Ignore non-4 time signatures
-                        out =  statematrix
-                        condition = False
-                        break
-                try:
-                    timeleft[i] = track[pos + 1].tick
-                    posns[i] += 1
-                except IndexError:
-                    timeleft[i] = None
-
-            if timeleft[i] is not None:
-                timeleft[i] -= 1
-
-        if all(t is None for t in timeleft):
-            break
 
-        time += 1
+def patternToNoteStateMatrix(pattern, span=span):
+    """
+    Transforms a midi pattern that has already been read into a note state matrix (see midiToNoteStateMatrix).
+
+    :param pattern: midi pattern
+    :param span: pitch range, default span (78)
+    :type pattern: midi.Pattern
+    :type span: int
+    :returns: matrix representation of song
+    :rtype: numpy array
+    """
+    # Merge every track into one stream of (absolute tick, track, position, event). Sorting on the first three keys
+    # keeps the order in which events were handled when stepping through the tracks one tick at a time.
+    events = []
+    end_time = 0
+    for i, track in enumerate(pattern):
+        time = 0
+        for pos, evt in enumerate(track):
+            time += evt.tick
+            events.append((time, i, pos, evt))
+        end_time = max(end_time, time)
+    events.sort(key=lambda e: e[:3])
+
+    # A new timestep starts at every tick where time % quarter == half, and an event at tick t belongs to the last
+    # timestep started at or before t (timestep 0 is the initial state)
+    quarter = pattern.resolution // 4
+    half = quarter // 2
 
-    S = np.array(statematrix)
-    statematrix = np.hstack((S[:, :, 0], S[:, :, 1]))
-    statematrix = np.asarray(statematrix).tolist()
+    def timestep(time):
+        return 0 if time < half else (time - half) // quarter + 1
+
+    for n, (time, _, _, evt) in enumerate(events):
+        if isinstance(evt, midi.TimeSignatureEvent) and evt.numerator not in timeSignatureNumerators:
+            # Ignore non-4 time signatures: stop at this event, keeping everything handled before it
+            events = events[:n]
+            end_time = time
+            break
+
+    statematrix = np.zeros((timestep(end_time) + 1, 2*span), dtype=np.uint8)
+    row = 0
+    for time, _, _, evt in events:
+        if not isinstance(evt, midi.NoteEvent) or evt.pitch < lowerBound or evt.pitch >= upperBound:
+            continue
+        current = timestep(time)
+        if current > row:
+            # Crossed one or more note boundaries. New timesteps default to holding the playing notes
+            statematrix[row+1:current+1, :span] = statematrix[row, :span]
+            row = current
+        note = evt.pitch - lowerBound
+        on = 0 if isinstance(evt, midi.NoteOffEvent) or evt.velocity == 0 else 1
+        statematrix[row, note] = on
+        statematrix[row, span+note] = on
+    statematrix[row+1:, :span] = statematrix[row, :span]
     return statematrix
 
 
-def noteStateMatrixToMidi(statematrix, name="example", span=span):
+def noteStateMatrixToMidi(statematrix, name="example", span=span, tickscale=55, tempo=None):
     """
     Transforms a matrix representation of notes and into a midi file.
+
+    Note on and note off events are found for the whole song at once by comparing each timestep with the previous
+    one. A silent timestep is added at the end so that notes still playing are switched off.
     
     :param statematrix: matrix representation of song
     :param name: name for midi file
     :param span: pitch range, default span (78)
+    :param tickscale: number of midi ticks per timestep, default 55 (a sixteenth note at the default resolution)
+    :param tempo: beats per minute written at the start of the track, by default none is written (120 bpm)
     :type statematrix: numpy array
     :type name: str
     :type span: int
+    :type tickscale: int
+    :type tempo: float
     :returns: None
     :rtype: None
     """
-    statematrix = np.array(statematrix)
-    if not len(statematrix.shape) == 3:
-        statematrix = np.dstack((statematrix[:, :span], statematrix[:, span:-2]))
-    statematrix = np.asarray(statematrix)
+    pattern = noteStateMatrixToPattern(statematrix, span, tickscale, tempo)
+    midi.write_midifile("{}.mid".format(name), pattern)
+
+
+def noteStateMatrixToPattern(statematrix, span=span, tickscale=55, tempo=None):
+    """
+    Transforms a matrix representation of notes into a midi pattern (see noteStateMatrixToMidi), e.g. to write it to
+    an open file with midi.write_midifile.
+
+    :param statematrix: matrix representation of song
+    :param span: pitch range, default span (78)
+    :param tickscale: number of midi ticks per timestep, default 55 (a sixteenth note at the default resolution)
+    :param tempo: beats per minute written at the start of the track, by default none is written (120 bpm)
+    :type statematrix: numpy array
+    :type span: int
+    :type tickscale: int
+    :type tempo: float
+    :returns: midi pattern of a single track
+    :rtype: midi.Pattern
+    """
     pattern = midi.Pattern()
     track = midi.Track()
     pattern.append(track)
-    
-    span = upperBound-lowerBound
-    tickscale = 55
-    
-    lastcmdtime = 0
-    prevstate = [[0,0] for x in range(span)]
-    for time, state in enumerate(statematrix + [prevstate[:]]):  
-        offNotes = []
-        onNotes = []
-        for i in range(span):
-            n = state[i]
-            p = prevstate[i]
-            if p[0] == 1:
-                if n[0] == 0:
-                    offNotes.append(i)
-                elif n[1] == 1:
-                    offNotes.append(i)
-                    onNotes.append(i)
-            elif n[0] == 1:
-                onNotes.append(i)
-        for note in offNotes:
-            track.append(midi.NoteOffEvent(tick=(time-lastcmdtime)*tickscale, pitch=note+lowerBound))
-            lastcmdtime = time
-        for note in onNotes:
-            track.append(midi.NoteOnEvent(tick=(time-lastcmdtime)*tickscale, velocity=120, pitch=note+lowerBound))
-            lastcmdtime = time
-            
-        prevstate = state
-    
+
+    if tempo is not None:
+        track.append(midi.SetTempoEvent(tick=0, bpm=tempo))
+
+    play, articulate = splitStateMatrix(statematrix, span)
+    silence = np.zeros((1, span), dtype=bool)
+    events, _ = noteEvents(np.vstack((play, silence)), np.vstack((articulate, silence)), tickscale=tickscale)
+    track.extend(events)
+
     eot = midi.EndOfTrackEvent(tick=1)
     track.append(eot)
+    return pattern
+
+
+def splitStateMatrix(statematrix, span=span):
+    """
+    Returns which notes are playing and which are articulated at each timestep of a matrix representation of notes,
+    given either as timesteps x span x 2, or as timesteps x (2*span+2) with the emotion values in the last two columns.
+
+    :param statematrix: matrix representation of song
+    :param span: pitch range, default span (78)
+    :type statematrix: numpy array
+    :type span: int
+    :returns: play and articulate matrices of timesteps x span
+    :rtype: tuple of numpy arrays of bool
+    """
+    statematrix = np.asarray(statematrix)
+    if not len(statematrix.shape) == 3:
+        statematrix = np.dstack((statematrix[:, :span], statematrix[:, span:-2]))
+    return statematrix[:, :span, 0] == 1, statematrix[:, :span, 1] == 1
+
+
+def noteEvents(play, articulate, prevplay=None, lastcmdtime=0, tickscale=55):
+    """
+    Finds the note on and note off events of a section of song by comparing each timestep with the previous one.
+    A note is switched off if it stops playing or is re-articulated, and switched on if it starts playing or is
+    re-articulated. At each timestep all the note offs come before the note ons, each in order of pitch.
+
+    :param play: notes playing, timesteps x span
+    :param articulate: notes articulated, timesteps x span
+    :param prevplay: notes playing just before the section, by default none
+    :param lastcmdtime: timestep of the last event before the section, relative to its first timestep, by default 0
+    :param tickscale: number of midi ticks per timestep, default 55
+    :type play: numpy array of bool
+    :type articulate: numpy array of bool
+    :type prevplay: numpy array of bool
+    :type lastcmdtime: int
+    :type tickscale: int
+    :returns: midi events, and timestep of the last event relative to the timestep after the section
+    :rtype: tuple
+    """
+    if prevplay is None:
+        prevplay = np.zeros(play.shape[1], dtype=bool)
+    prev = np.vstack((prevplay, play[:-1]))
+    offNotes = prev & (~play | articulate)
+    onNotes = play & (~prev | articulate)
+
+    offTimes, offPitches = np.nonzero(offNotes)
+    onTimes, onPitches = np.nonzero(onNotes)
+    times = np.concatenate((offTimes, onTimes))
+    pitches = np.concatenate((offPitches, onPitches)) + lowerBound
+    isOn = np.concatenate((np.zeros(len(offTimes), dtype=bool), np.ones(len(onTimes), dtype=bool)))
+    order = np.lexsort((pitches, isOn, times))
+    times, pitches, isOn = times[order], pitches[order], isOn[order]
+    ticks = np.diff(np.concatenate(([lastcmdtime], times))) * tickscale
+
+    events = [midi.NoteOnEvent(tick=tick, velocity=120, pitch=pitch) if on else
+              midi.NoteOffEvent(tick=tick, pitch=pitch)
+              for tick, pitch, on in zip(ticks.tolist(), pitches.tolist(), isOn.tolist())]
+    if len(times):
+        lastcmdtime = times[-1]
+    return events, lastcmdtime - len(play)
+
+
+class StreamingMidiWriter(object):
+    """
+    Writes a midi file one section of song at a time, so music can be saved while it is still being generated and
+    without keeping the whole song in memory. Produces the same file as noteStateMatrixToMidi on the whole song: the
+    events of each section are encoded and appended as soon as it is written, and the track length in the header is
+    filled in when the writer is closed.
+    """
+
+    def __init__(self, name="example", span=span, tickscale=55, tempo=None):
+        """
+        :param name: name for midi file
+        :param span: pitch range, default span (78)
+        :param tickscale: number of midi ticks per timestep, default 55 (a sixteenth note at the default resolution)
+        :param tempo: beats per minute written at the start of the track, by default none is written (120 bpm)
+        :type name: str
+        :type span: int
+        :type tickscale: int
+        :type tempo: float
+        """
+        self.span = span
+        self.tickscale = tickscale
+        self.prevplay = np.zeros(span, dtype=bool)
+        self.lastcmdtime = 0
+        self.track_length = 0
+        self.encoder = midi.FileWriter()
+        self.encoder.RunningStatus = None
+
+        pattern = midi.Pattern()
+        pattern.append(midi.Track())
+        self.file = open("{}.mid".format(name), 'wb')
+        self.encoder.write_file_header(self.file, pattern)
+        self.track_header = self.file.tell()
+        self.file.write(self.encoder.encode_track_header(0))
+        if tempo is not None:
+            self.append([midi.SetTempoEvent(tick=0, bpm=tempo)])
+
+    def append(self, events):
+        """
+        Encodes midi events and appends them to the track.
+
+        :param events: midi events, in order
+        :type events: list
+        :returns: None
+        :rtype: None
+        """
+        data = ''.join(self.encoder.encode_midi_event(evt) for evt in events)
+        self.file.write(data)
+        self.track_length += len(data)
+
+    def write(self, statematrix):
+        """
+        Appends the next section of song.
+
+        :param statematrix: matrix representation of the section
+        :type statematrix: numpy array
+        :returns: None
+        :rtype: None
+        """
+        play, articulate = splitStateMatrix(statematrix, self.span)
+        if not len(play):
+            return
+        events, self.lastcmdtime = noteEvents(play, articulate, self.prevplay, self.lastcmdtime, self.tickscale)
+        self.append(events)
+        self.prevplay = play[-1]
+        self.file.flush()
+
+    def close(self):
+        """
+        Switches off the notes still playing, ends the track and closes the file.
+
+        :returns: None
+        :rtype: None
+        """
+        silence = np.zeros((1, self.span), dtype=bool)
+        events, _ = noteEvents(silence, silence, self.prevplay, self.lastcmdtime, self.tickscale)
+        self.append(events + [midi.EndOfTrackEvent(tick=1)])
+        self.file.seek(self.track_header)
+        self.file.write(self.encoder.encode_track_header(self.track_length))
+        self.file.close()
+
+    def __enter__(self):
+        return self
 
-    midi.write_midifile("{}.mid".format(name), pattern)
\ No newline at end of file
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,382 @@
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+import numpy as np
+import rbm
+import chunk_dataset
+import run_state
+import training_metrics
+
+
+modes = ("hogwild", "sync")
+
+epochs_to_save = 5 # Number of epochs to run between saving each checkpoint
+monitor_size = 200 # Number of sections the model is measured on at the end of each epoch
+validation_size = 500 # Largest number of held-out sections the model is validated on
+
+
+def shared_array(values):
+    """
+    Copies an array into shared memory, so that processes forked afterwards read and write the same values.
+
+    :param values: array to copy
+    :type values: numpy array
+    :returns: the shared buffer and a float32 array using it
+    :rtype: tuple
+    """
+    values = np.asarray(values, dtype=np.float32)
+    buf = multiprocessing.RawArray('f', int(values.size))
+    array = np.frombuffer(buf, dtype=np.float32).reshape(values.shape)
+    array[...] = values
+    return buf, array
+
+
+def train_worker(index, dataset_dir, params, gradients, tasks, results, k, seed):
+    """
+    Runs in a worker process of a ParallelTrainer: reads the sections listed by each task from the dataset, and
+    either updates the shared weights and biases with them (hogwild) or writes their contrastive divergence statistics
+    to the worker's slot of the shared gradients (sync). Reports the number of examples, the seconds spent reading
+    them and computing, and their mean squared reconstruction error for every task, until it receives None.
+
+    :returns: None
+    :rtype: None
+    """
+    dataset = chunk_dataset.ChunkDataset(dataset_dir)
+    model = rbm.NumpyRBM(*[np.frombuffer(buf, dtype=np.float32).reshape(shape) for buf, shape in params],
+                         seed=None if seed is None else seed + index + 1)
+    if gradients is not None:
+        slots = [np.frombuffer(buf, dtype=np.float32).reshape(shape)[index] for buf, shape in gradients]
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        try:
+            start = time.time()
+            x = dataset.batch(task)
+            prepared = time.time()
+            if gradients is None:
+                error = model.train_batch(x, k) # no lock: updates of other workers may interleave (Hogwild)
+            else:
+                x_sample = model.gibbs_sample(x, k)
+                for slot, statistics in zip(slots, model.gradients(x, k, x_sample)):
+                    slot[...] = statistics
+                error = float(np.mean(np.square(x - x_sample)))
+            results.put((len(task), prepared - start, time.time() - prepared, error, None))
+        except Exception:
+            results.put((len(task), 0.0, 0.0, None, traceback.format_exc()))
+
+
+class ParallelTrainer(object):
+    """
+    Trains a NumpyRBM on a ChunkDataset with several worker processes sharing its weights and biases in memory.
+
+    * "hogwild": every worker runs whole batches and updates the shared parameters without locking, as in Hogwild.
+      Updates of different workers may overwrite each other's changes in part, which sparse, noisy contrastive
+      divergence updates tolerate.
+    * "sync": every batch is split between the workers, which compute the statistics of their part from the same
+      parameters. Their sum is applied as one update, the same as a single process training on the whole batch.
+
+    The dataset is memory-mapped, so workers read their sections from the page cache and only indices are sent to
+    them.
+    """
+
+    def __init__(self, dataset_dir, model, workers=None, mode="hogwild", k=1, seed=None):
+        """
+        :param dataset_dir: folder of a ChunkDataset (see chunk_dataset.build_chunk_dataset)
+        :param model: RBM to train, its weights and biases are copied into shared memory
+        :param workers: number of worker processes, by default the number of processors
+        :param mode: "hogwild" or "sync", by default "hogwild"
+        :param k: number of Gibbs steps per update, by default 1
+        :param seed: seed of the workers' random number generators, by default random
+        :type dataset_dir: str
+        :type model: rbm.NumpyRBM
+        :type workers: int
+        :type mode: str
+        :type k: int
+        :type seed: int
+        """
+        if mode not in modes:
+            raise ValueError("unknown mode {}".format(mode))
+        self.dataset = chunk_dataset.ChunkDataset(dataset_dir)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.mode = mode
+        self.k = k
+
+        shared = [shared_array(values) for values in (model.W, model.bh, model.bv)]
+        params = [(buf, array.shape) for buf, array in shared]
+        self.model = rbm.NumpyRBM(*[array for _, array in shared], seed=seed)
+        if mode == "sync":
+            # in the order of rbm.NumpyRBM.gradients
+            grads = [shared_array(np.zeros((self.workers,) + array.shape, np.float32))
+                     for array in (self.model.W, self.model.bv, self.model.bh)]
+            self.gradients = [array for _, array in grads]
+            gradients = [(buf, array.shape) for buf, array in grads]
+            self.tasks = [multiprocessing.Queue() for _ in range(self.workers)]
+        else:
+            gradients = None
+            self.tasks = [multiprocessing.Queue()]*self.workers
+        self.results = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=train_worker,
+                                                  args=(i, dataset_dir, params, gradients, self.tasks[i],
+                                                        self.results, k, seed))
+                          for i in range(self.workers)]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    def result(self, metrics):
+        examples, data_seconds, run_seconds, error, failure = self.results.get()
+        if failure is not None:
+            raise RuntimeError("Training worker failed:\n{}".format(failure))
+        if metrics is not None and self.mode == "hogwild":
+            metrics.update(examples, run_seconds, error, data_seconds)
+        return examples, data_seconds, run_seconds, error
+
+    def train_epoch(self, batch_size, rng=np.random, metrics=None, indices=None):
+        """
+        Trains on every section of the dataset once, in shuffled order, batch_size sections per update.
+
+        :param batch_size: number of sections per update
+        :param rng: random number generator ordering the sections, by default numpy's global one
+        :param metrics: logger recording every update, by default none
+        :param indices: sections to train on, by default all of them
+        :type batch_size: int
+        :type rng: numpy RandomState
+        :type metrics: training_metrics.MetricsLogger
+        :type indices: numpy array of int
+        :returns: number of sections trained on
+        :rtype: int
+        """
+        order = rng.permutation(np.arange(len(self.dataset)) if indices is None else indices)
+        batches = [order[start:start+batch_size] for start in range(0, len(order), batch_size)]
+        if self.mode == "hogwild":
+            for batch in batches:
+                self.tasks[0].put(batch)
+            for _ in batches:
+                self.result(metrics)
+            return len(order)
+
+        for batch in batches:
+            parts = [part for part in np.array_split(batch, self.workers) if len(part)]
+            for tasks, part in zip(self.tasks, parts):
+                tasks.put(part)
+            data_seconds = run_seconds = squared_error = 0.0
+            for _ in parts:
+                examples, data, run, error = self.result(metrics)
+                data_seconds = max(data_seconds, data)
+                run_seconds = max(run_seconds, run)
+                squared_error += error*examples # the parts have the same number of columns
+            error = squared_error/len(batch)
+            self.model.apply_gradients(*[gradient[:len(parts)].sum(axis=0) for gradient in self.gradients],
+                                       size_bt=len(batch))
+            if metrics is not None:
+                metrics.update(len(batch), run_seconds, error, data_seconds)
+        return len(order)
+
+    def close(self):
+        for tasks in self.tasks: # in hogwild mode the same queue, once per worker
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def measure_scaling(dataset_dir, worker_counts, mode="hogwild", batch_size=rbm.batch_size, epochs=1, seed=0):
+    """
+    Trains the same untrained RBM for a few epochs with each number of workers, and measures the number of sections
+    trained per second and the reconstruction error reached (see training_metrics.parameter_statistics).
+    The scaling efficiency of n workers is their throughput divided by n times the throughput of one worker (or of
+    the smallest number of workers measured).
+
+    :param dataset_dir: folder of a ChunkDataset
+    :param worker_counts: numbers of worker processes to measure
+    :param mode: "hogwild" or "sync", by default "hogwild"
+    :param batch_size: number of sections per update, by default batch_size (100)
+    :param epochs: number of epochs per measurement, by default 1
+    :param seed: seed of the model and of the order of the sections, by default 0
+    :type dataset_dir: str
+    :type worker_counts: list of int
+    :type mode: str
+    :type batch_size: int
+    :type epochs: int
+    :type seed: int
+    :returns: one row per number of workers holding workers, examples_per_second, efficiency and
+              reconstruction_error
+    :rtype: list of dict
+    """
+    dataset = chunk_dataset.ChunkDataset(dataset_dir)
+    monitor = dataset.batch(np.random.RandomState(0).permutation(len(dataset))[:monitor_size])
+    rows = []
+    for workers in sorted(worker_counts):
+        start_model = rbm.NumpyRBM.random(n_visible=dataset.n_visible, seed=seed)
+        with ParallelTrainer(dataset_dir, start_model, workers, mode, seed=seed) as trainer:
+            rng = np.random.RandomState(seed)
+            start = time.time()
+            examples = sum(trainer.train_epoch(batch_size, rng) for _ in range(epochs))
+            seconds = time.time() - start
+            statistics = training_metrics.parameter_statistics(trainer.model, monitor)
+        rows.append({"workers": workers, "examples_per_second": examples/seconds,
+                     "reconstruction_error": statistics["reconstruction_error"]})
+    base = rows[0]
+    for row in rows:
+        row["efficiency"] = (row["examples_per_second"]*base["workers"]/
+                             (row["workers"]*base["examples_per_second"]))
+    return rows
+
+
+def main():
+    """
+    Trains the RBM with the NumPy engine on every processor, or measures how training scales with the number of
+    worker processes. The trained model is saved as a .npz file, which rbm_generation and generation_server load.
+
+    This method is run through the command-line interface
+    :returns: None
+    :rtype: None
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Folder of midi files and emotion text files", type=str, default="Midi_Files")
+    parser.add_argument("--cache-dir", help="Folder of the song cache and section dataset", type=str,
+                        default="song_cache")
+    parser.add_argument("--workers", help="Number of worker processes, by default one per processor", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--mode", help="hogwild (lock-free updates) or sync (averaged statistics)", choices=modes,
+                        default="hogwild")
+    parser.add_argument("--epochs", help="Number of epochs", type=int, default=rbm.num_epochs)
+    parser.add_argument("--batch-size", help="Number of sections per update", type=int, default=rbm.batch_size)
+    parser.add_argument("--seed", help="Seed of the order of the sections and of sampling", type=int, default=None)
+    parser.add_argument("--output", help="Trained model", type=str, default="parameter_checkpoints/trained_system.npz")
+    parser.add_argument("--resume", help="Checkpoint to continue training from, by default the latest one",
+                        type=str, nargs="?", const="latest", default=None)
+    parser.add_argument("--keep-last", help="Number of most recent epoch checkpoints kept", type=int, default=3)
+    parser.add_argument("--keep-every", help="Epoch checkpoints of every this many epochs are kept as well",
+                        type=int, default=25)
+    parser.add_argument("--validation-fraction", help="Fraction of the sections (whole songs) held out for "
+                                                      "validation", type=float, default=0.1)
+    parser.add_argument("--validate-every", help="Number of epochs between validations", type=int, default=1)
+    parser.add_argument("--patience", help="Stop after this many validations without improvement", type=int,
+                        default=training_metrics.default_patience)
+    parser.add_argument("--min-delta", help="Smallest decrease of the validation error counted as an improvement",
+                        type=float, default=0.0)
+    parser.add_argument("--max-gap", help="Stop once the held-out free energy exceeds the training free energy by "
+                                          "more than this", type=float, default=None)
+    parser.add_argument("--scaling", help="Measure the scaling efficiency of these numbers of workers instead of "
+                                          "training, e.g. 1,2,4,8", type=str, default=None)
+    args = parser.parse_args()
+
+    dataset_dir = os.path.join(args.cache_dir, "sections")
+    dataset = chunk_dataset.load_chunk_dataset(args.path, dataset_dir, rbm.num_timesteps, cache_dir=args.cache_dir,
+                                               workers=multiprocessing.cpu_count())
+    print "{} sections of {} timesteps".format(len(dataset), rbm.num_timesteps)
+
+    if args.scaling is not None:
+        print "{:>7} {:>10} {:>10} {:>12}".format("workers", "examples/s", "efficiency", "recon error")
+        for row in measure_scaling(dataset_dir, [int(n) for n in args.scaling.split(",")], args.mode,
+                                   args.batch_size, seed=args.seed or 0):
+            print "{:>7} {:>10.1f} {:>10.0%} {:>12.5f}".format(row["workers"], row["examples_per_second"],
+                                                                row["efficiency"], row["reconstruction_error"])
+        return
+
+    checkpoint_dir = os.path.dirname(args.output) or "."
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    hyperparameters = {
+        "lr": rbm.lr,
+        "batch_size": args.batch_size,
+        "num_epochs": args.epochs,
+        "num_timesteps": rbm.num_timesteps,
+        "n_hidden": rbm.n_hidden,
+        "seed": args.seed if args.seed is not None else np.random.randint(2**31 - 1),
+        "mode": args.mode,
+        "validation_fraction": args.validation_fraction,
+        "validate_every": args.validate_every,
+        "patience": args.patience,
+        "min_delta": args.min_delta,
+        "max_gap": args.max_gap,
+    }
+    start_epoch = 0
+    checkpoint = None
+    progress = {}
+    if args.resume is not None:
+        checkpoint = (run_state.latest_checkpoint(checkpoint_dir, "numpy_epoch") if args.resume == "latest"
+                      else args.resume)
+        if checkpoint is None:
+            raise ValueError("{} holds no checkpoint to resume from".format(checkpoint_dir))
+        start_epoch, rng, saved = run_state.load_run_state(checkpoint)
+        hyperparameters.update(saved)
+        progress = run_state.load_progress(checkpoint)
+        model = rbm.NumpyRBM.load(checkpoint + ".npz")
+        print "Resuming from {} after {} epochs".format(checkpoint, start_epoch)
+    else:
+        rng = np.random.RandomState(hyperparameters["seed"])
+        model = rbm.NumpyRBM.random(n_visible=dataset.n_visible, seed=hyperparameters["seed"])
+    rbm.lr = hyperparameters["lr"] # read by rbm.batch_lr, also in the worker processes forked below
+
+    # Whole songs are held out to validate the model, always the same ones for a given fraction
+    train_sections, validation_sections = dataset.split(hyperparameters["validation_fraction"])
+    monitor = dataset.batch(np.random.RandomState(0).permutation(train_sections)[:monitor_size])
+    validation = dataset.batch(np.random.RandomState(0).permutation(validation_sections)[:validation_size])
+    # as many training sections as held-out ones, for the free energy gap
+    train_sample = dataset.batch(np.random.RandomState(0).permutation(train_sections)[:len(validation)])
+    early_stopping = training_metrics.EarlyStopping(hyperparameters["patience"], hyperparameters["min_delta"],
+                                                    hyperparameters["max_gap"], progress.get("early_stopping"))
+    metrics = training_metrics.MetricsLogger(os.path.join(checkpoint_dir, "numpy_training_metrics.jsonl"),
+                                             mode='w' if checkpoint is None else 'a')
+    metrics.start(sections=len(dataset), num_timesteps=rbm.num_timesteps, n_visible=dataset.n_visible,
+                  batch_size=hyperparameters["batch_size"], num_epochs=hyperparameters["num_epochs"],
+                  lr=rbm.lr, start_epoch=start_epoch, workers=args.workers, mode=hyperparameters["mode"])
+
+    with ParallelTrainer(dataset_dir, model, args.workers, hyperparameters["mode"],
+                         seed=hyperparameters["seed"] + start_epoch) as trainer:
+        for epoch in range(start_epoch, hyperparameters["num_epochs"]):
+            trainer.train_epoch(hyperparameters["batch_size"], rng, metrics, train_sections)
+            metrics.epoch(epoch, trainer.model, monitor)
+
+            # Measure the model on the held-out songs, keep the best one so far and stop once it no longer improves
+            stop = None
+            if (epoch + 1) % hyperparameters["validate_every"] == 0 and len(validation):
+                statistics = training_metrics.validation_statistics(trainer.model, train_sample, validation)
+                improved, stop = early_stopping.update(epoch, statistics["validation_reconstruction_error"],
+                                                       statistics["free_energy_gap"])
+                metrics.validation(epoch, statistics, early_stopping.best_epoch)
+                if improved:
+                    # named after its epoch, so a run resumed from an earlier checkpoint never restores the best
+                    # model of the run it abandoned
+                    early_stopping.best_checkpoint = os.path.join(checkpoint_dir, "numpy_best-{}".format(epoch))
+                    trainer.model.save(early_stopping.best_checkpoint + ".npz")
+                    run_state.save_run_state(early_stopping.best_checkpoint, epoch + 1, rng, hyperparameters,
+                                             {"early_stopping": early_stopping.state()})
+                    run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint, "numpy_best",
+                                                     "numpy_epoch")
+
+            if (epoch + 1) % epochs_to_save == 0 or stop is not None:
+                checkpoint_path = os.path.join(checkpoint_dir, "numpy_epoch-{}".format(epoch))
+                trainer.model.save(checkpoint_path + ".npz")
+                run_state.save_run_state(checkpoint_path, epoch + 1, rng, hyperparameters,
+                                         {"early_stopping": early_stopping.state()})
+                run_state.prune_checkpoints(checkpoint_dir, args.keep_last, args.keep_every, "numpy_epoch")
+                if early_stopping.best_checkpoint is not None:
+                    run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint, "numpy_best",
+                                                     "numpy_epoch")
+            if stop is not None:
+                print "Stopped after {} epochs: {}".format(epoch + 1, stop)
+                break
+
+    # The trained system is the model of the best validation
+    if early_stopping.best_checkpoint is not None:
+        print "Best validation after {} epochs".format(early_stopping.best_epoch + 1)
+        rbm.NumpyRBM.load(early_stopping.best_checkpoint + ".npz").save(args.output)
+        run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint, "numpy_best", "numpy_epoch")
+    else:
+        trainer.model.save(args.output)
+    metrics.close()
+    print "Saved {}".format(args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 # Code based on Dan Shiebler's RBM music generator: https://github.com/dshieble/Music_RBM
 
-import tensorflow as tf
+import numpy as np
 import midi_manipulation
 
 note_range = midi_manipulation.span # The range of notes that we can produce (=78)
@@ -8,16 +8,17 @@ note_range = midi_manipulation.span # The range of notes that we can produce (=7
 num_timesteps  = 64 # Number of timesteps that we will create at a time (~= 4 measures/16 quarter notes)
 n_visible      = (2*(note_range)+2)*(num_timesteps) # Number of nodes in the visible layer (=10112)
 n_hidden       = 50 # Number of nodes in the hidden layer
+emotion_timesteps = 16 # Number of timesteps sharing one line of emotion values (extracted every 16 timesteps)
 
 num_epochs = 200 # Number of training epochs - each epoch we go through the entire data set
 batch_size = 100 # Number of training examples that are sent through the RBM at a time
-lr         = tf.constant(0.005, tf.float32) # The learning rate of our model
+lr         = 0.005 # The learning rate of our model
 
 def get_variables():
 	"""
 	Returns variables used to train the model and generate from the model
 
-	:param x: placeholder that holds music data
+	:param x: placeholder that holds music data, one row per example
 	:param emotions: placeholder that holds the emotion data
 	:param W: matrix that stores the edge weights between the visible and hidden layers
 	:param bh: vector that stores the bias values for the hidden layer
@@ -30,10 +31,294 @@ def get_variables():
 	:returns: all variables defined (x, emotions, W, bh, bv)
 	rtype: tuple of tensors
 	"""
-	x  = tf.placeholder(tf.float32, [1, n_visible], name="x") 
+	import tensorflow as tf
+	x  = tf.placeholder(tf.float32, [None, n_visible], name="x") 
 	emotions  = tf.placeholder(tf.float32, [8,], name="emotions") 
 	W  = tf.Variable(tf.random_normal([n_visible, n_hidden], 0.01), name="W") 
 	bh = tf.Variable(tf.zeros([1, n_hidden],  tf.float32, name="bh")) 
 	bv = tf.Variable(tf.zeros([1, n_visible],  tf.float32, name="bv")) 
 	return x, emotions, W, bh, bv
 
+
+def batch_lr(size_bt):
+	"""
+	Returns the learning rate for an update averaged over a batch of examples. lr was tuned for updates of a single
+	example, so it is scaled linearly with the batch size: one update then moves the weights as far as the per-example
+	updates of the whole batch would have.
+
+	:param size_bt: number of examples in the batch
+	:type size_bt: tensor or int
+	:returns: learning rate of the batch update
+	:rtype: tensor or float
+	"""
+	return lr*size_bt
+
+
+def emotion_columns(num_timesteps=num_timesteps):
+	"""
+	Returns the positions of the arousal and valence values (the last two elements of each timestep) in a visible
+	vector of num_timesteps.
+
+	:param num_timesteps: number of timesteps in the visible vector, by default num_timesteps (64)
+	:type num_timesteps: int
+	:returns: indices of the emotion values, arousal and valence of each timestep in turn
+	:rtype: numpy array of int
+	"""
+	width = 2*note_range+2
+	starts = np.arange(num_timesteps)*width + 2*note_range
+	return np.dstack((starts, starts+1)).ravel()
+
+
+class NumpyRBM(object):
+	"""
+	The RBM of training.py and the generators, run with NumPy instead of a TensorFlow graph and session. It follows the
+	same equations in float32: hidden and visible units are sampled as floor(probability + uniform noise), training
+	does one contrastive divergence update per batch, and generation runs Gibbs chains with the emotion values clamped.
+	Rows of every matrix are independent examples or chains.
+	"""
+
+	def __init__(self, W, bh, bv, seed=None):
+		"""
+		:param W: edge weights between the visible and hidden layers, n_visible x n_hidden
+		:param bh: bias values of the hidden layer, 1 x n_hidden
+		:param bv: bias values of the visible layer, 1 x n_visible
+		:param seed: seed of the random number generator used for sampling, by default random
+		:type W: numpy array
+		:type bh: numpy array
+		:type bv: numpy array
+		:type seed: int
+		"""
+		self.W = np.ascontiguousarray(W, dtype=np.float32)
+		self.bh = np.ascontiguousarray(np.reshape(bh, (1, -1)), dtype=np.float32)
+		self.bv = np.ascontiguousarray(np.reshape(bv, (1, -1)), dtype=np.float32)
+		self.rng = np.random.RandomState(seed)
+
+	@classmethod
+	def random(cls, n_visible=n_visible, n_hidden=n_hidden, seed=None):
+		"""
+		Returns an untrained RBM initialised like get_variables: weights drawn from a normal distribution of mean 0.01
+		and standard deviation 1, biases set to 0.
+
+		:param n_visible: number of visible nodes, by default n_visible (10112)
+		:param n_hidden: number of hidden nodes, by default n_hidden (50)
+		:param seed: seed of the random number generator, by default random
+		:type n_visible: int
+		:type n_hidden: int
+		:type seed: int
+		:returns: untrained RBM
+		:rtype: NumpyRBM
+		"""
+		rbm = cls(np.zeros((n_visible, n_hidden)), np.zeros((1, n_hidden)), np.zeros((1, n_visible)), seed)
+		rbm.W[...] = rbm.rng.normal(0.01, 1.0, rbm.W.shape)
+		return rbm
+
+	@classmethod
+	def load(cls, file_name, seed=None):
+		"""
+		Reads an RBM written with save.
+
+		:param file_name: path to .npz file
+		:param seed: seed of the random number generator used for sampling, by default random
+		:type file_name: str
+		:type seed: int
+		:returns: RBM
+		:rtype: NumpyRBM
+		"""
+		params = np.load(file_name)
+		return cls(params["W"], params["bh"], params["bv"], seed)
+
+	@classmethod
+	def from_checkpoint(cls, checkpoint_path, seed=None):
+		"""
+		Reads the weights and biases from a TensorFlow checkpoint written by training.py (requires TensorFlow).
+		get_variables only names W, so the biases are stored under TensorFlow's default names, in the order they
+		were created.
+
+		:param checkpoint_path: path to the checkpoint, e.g. "parameter_checkpoints/trained_system"
+		:param seed: seed of the random number generator used for sampling, by default random
+		:type checkpoint_path: str
+		:type seed: int
+		:returns: RBM
+		:rtype: NumpyRBM
+		"""
+		import tensorflow as tf
+		reader = tf.train.NewCheckpointReader(checkpoint_path)
+		return cls(reader.get_tensor("W"), reader.get_tensor("Variable"), reader.get_tensor("Variable_1"), seed)
+
+	def save(self, file_name):
+		"""
+		Writes the weights and biases to a .npz file.
+
+		:param file_name: path to .npz file
+		:type file_name: str
+		:returns: None
+		:rtype: None
+		"""
+		np.savez(file_name, W=self.W, bh=self.bh, bv=self.bv)
+
+	def sample(self, probs):
+		"""
+		Samples 0s and 1s in place: each probability is added to a random value between 0 and 1, and rounded down.
+
+		:param probs: matrix of probabilities, overwritten with the samples
+		:type probs: numpy array of float32
+		:returns: probs
+		:rtype: numpy array of float32
+		"""
+		probs += self.rng.random_sample(probs.shape).astype(np.float32)
+		return np.floor(probs, out=probs)
+
+	@staticmethod
+	def sigmoid(x):
+		"""
+		Logistic function computed in place, as 0.5*(1+tanh(x/2)) to avoid overflow.
+
+		:param x: matrix, overwritten with the result
+		:type x: numpy array of float32
+		:returns: x
+		:rtype: numpy array of float32
+		"""
+		x *= 0.5
+		np.tanh(x, out=x)
+		x += 1
+		x *= 0.5
+		return x
+
+	def hidden_probs(self, v):
+		"""
+		Propagates the visible values to the probabilities of the hidden nodes.
+
+		:param v: visible values, one row per example
+		:type v: numpy array
+		:returns: matrix of examples x n_hidden
+		:rtype: numpy array of float32
+		"""
+		h = np.dot(v, self.W)
+		h += self.bh
+		return self.sigmoid(h)
+
+	def visible_probs(self, h):
+		"""
+		Propagates the hidden values to the probabilities of the visible nodes.
+
+		:param h: hidden values, one row per example
+		:type h: numpy array
+		:returns: matrix of examples x n_visible
+		:rtype: numpy array of float32
+		"""
+		v = np.dot(h, self.W.T)
+		v += self.bv
+		return self.sigmoid(v)
+
+	def free_energy(self, v):
+		"""
+		Free energy of each visible vector, -v.bv - sum(log(1 + exp(v.W + bh))). Lower values are more probable under
+		the model, so it can be compared between samples or between training and held-out examples.
+
+		:param v: visible values, one row per example
+		:type v: numpy array
+		:returns: free energy of each row
+		:rtype: numpy array of float32
+		"""
+		v = np.asarray(v, dtype=np.float32)
+		h = np.dot(v, self.W)
+		h += self.bh
+		return -np.dot(v, self.bv[0]) - np.logaddexp(0, h).sum(axis=1)
+
+	def gibbs_sample(self, v, k, clamp_columns=None):
+		"""
+		Runs a k-step Gibbs chain from each row of v. With clamp_columns given, those columns keep their values from
+		v after every step, e.g. the emotion values during generation (see emotion_columns).
+
+		:param v: visible values the chains start from, one row per chain
+		:param k: number of Gibbs steps
+		:param clamp_columns: indices of the visible nodes to clamp, by default none
+		:type v: numpy array
+		:type k: int
+		:type clamp_columns: numpy array of int
+		:returns: visible values sampled, one row per chain
+		:rtype: numpy array of float32
+		"""
+		v = np.asarray(v, dtype=np.float32)
+		if clamp_columns is not None:
+			clamped = v[:, clamp_columns]
+		for _ in range(k):
+			h = self.sample(self.hidden_probs(v)) # Propagate the visible values to sample the hidden values
+			v = self.sample(self.visible_probs(h)) # Propagate the hidden values to sample the visible values
+			if clamp_columns is not None:
+				v[:, clamp_columns] = clamped
+		return v
+
+	def gradients(self, x, k=1, x_sample=None):
+		"""
+		Contrastive divergence statistics of a batch of examples, summed over the batch: the difference between the
+		statistics of the examples and of the samples of a k-step Gibbs chain started from them. train_batch scales
+		them by the learning rate; sums from several parts of a batch add up to the statistics of the whole batch.
+
+		:param x: training examples, one row per example
+		:param k: number of Gibbs steps, by default 1
+		:param x_sample: samples of the Gibbs chains started from x, by default sampled here
+		:type x: numpy array
+		:type k: int
+		:type x_sample: numpy array
+		:returns: statistics of W (n_visible x n_hidden), bv (1 x n_visible) and bh (1 x n_hidden)
+		:rtype: tuple of numpy arrays
+		"""
+		x = np.asarray(x, dtype=np.float32)
+		if x_sample is None:
+			x_sample = self.gibbs_sample(x, k)
+		h = self.sample(self.hidden_probs(x))
+		h_sample = self.sample(self.hidden_probs(x_sample))
+
+		W_adder = np.dot(x.T, h)
+		W_adder -= np.dot(x_sample.T, h_sample)
+		bv_adder = x.sum(0, keepdims=True) - x_sample.sum(0, keepdims=True)
+		bh_adder = h.sum(0, keepdims=True) - h_sample.sum(0, keepdims=True)
+		return W_adder, bv_adder, bh_adder
+
+	def apply_gradients(self, W_adder, bv_adder, bh_adder, size_bt, lr=None):
+		"""
+		Moves the weights and biases by summed contrastive divergence statistics (see gradients), averaged over the
+		size_bt examples they were computed from. W_adder is overwritten.
+
+		:param W_adder: statistics of W
+		:param bv_adder: statistics of bv
+		:param bh_adder: statistics of bh
+		:param size_bt: number of examples
+		:param lr: learning rate of the update, by default batch_lr of the batch size
+		:type W_adder: numpy array
+		:type bv_adder: numpy array
+		:type bh_adder: numpy array
+		:type size_bt: int
+		:type lr: float
+		:returns: None
+		:rtype: None
+		"""
+		if lr is None:
+			lr = batch_lr(size_bt)
+		scale = np.float32(lr/float(size_bt))
+		W_adder *= scale
+		self.W += W_adder
+		self.bv += scale*bv_adder
+		self.bh += scale*bh_adder
+
+	def train_batch(self, x, k=1, lr=None):
+		"""
+		Runs one contrastive divergence update on a batch of examples, as training.py does: the weights and biases
+		move by the difference between the statistics of the examples and of the samples of a k-step Gibbs chain
+		started from them, averaged over the batch.
+
+		:param x: training examples, one row per example
+		:param k: number of Gibbs steps, by default 1
+		:param lr: learning rate of the update, by default batch_lr of the batch size
+		:type x: numpy array
+		:type k: int
+		:type lr: float
+		:returns: mean squared difference between the batch and its reconstruction, as reconstruction_error in
+		          training.py
+		:rtype: float
+		"""
+		x = np.asarray(x, dtype=np.float32)
+		x_sample = self.gibbs_sample(x, k)
+		self.apply_gradients(*self.gradients(x, k, x_sample), size_bt=len(x), lr=lr)
+		return float(np.mean(np.square(x - x_sample)))
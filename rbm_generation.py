@@ -0,0 +1,532 @@
+import argparse
+import collections
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+import rbm
+import midi_manipulation
+import compact_song
+import samplers
+
+
+num_timesteps = rbm.num_timesteps
+lines_per_segment = num_timesteps // rbm.emotion_timesteps # Lines of emotion values per generated segment (=4)
+
+modes = ("feedback", "sampling")
+
+
+def load_model(path, seed=None):
+	"""
+	Loads a trained RBM into the NumPy engine, either from a .npz file written by NumpyRBM.save or from a TensorFlow
+	checkpoint written by training.py (requires TensorFlow).
+
+	:param path: path to .npz file or checkpoint
+	:param seed: seed of the random number generator used for sampling, by default random
+	:type path: str
+	:type seed: int
+	:returns: trained RBM
+	:rtype: rbm.NumpyRBM
+	"""
+	if path.endswith(".npz"):
+		return rbm.NumpyRBM.load(path, seed)
+	return rbm.NumpyRBM.from_checkpoint(path, seed)
+
+
+def read_emotion_segments(emotion_text_file):
+	"""
+	Reads an emotion text file and groups its lines into the segments sent through the RBM, 4 lines (64 timesteps)
+	per segment. Lines after the last full segment are dropped, as in generate_music.
+
+	:param emotion_text_file: path to text file holding emotion data
+	:type emotion_text_file: str
+	:returns: matrix of segments x 4 x 2 (arousal, valence)
+	:rtype: numpy array of float32
+	"""
+	emotions = midi_manipulation.read_emotions(emotion_text_file)
+	segments = len(emotions) // lines_per_segment
+	return np.reshape(emotions[:segments*lines_per_segment], (segments, lines_per_segment, 2))
+
+
+def clamp_emotions(v, segments):
+	"""
+	Writes the emotion values of one segment per row into visible vectors, each line of emotion values covering 16
+	timesteps.
+
+	:param v: visible vectors, overwritten, one row per chain
+	:param segments: emotion values of each chain's segment, chains x 4 x 2
+	:type v: numpy array
+	:type segments: numpy array
+	:returns: v
+	:rtype: numpy array
+	"""
+	v[:, rbm.emotion_columns()] = np.reshape(np.repeat(segments, rbm.emotion_timesteps, axis=1), (len(v), -1))
+	return v
+
+
+def gibbs_steps(mode, segment):
+	"""
+	Returns the number of Gibbs steps run for a segment. The sampling generator runs 10 steps for every segment.
+	The feedback generator runs 5 steps for the first 3 segments (first 12 measures), due to sparse notes played
+	otherwise, and 1 step afterwards.
+
+	:param mode: "feedback" or "sampling"
+	:param segment: index of the segment
+	:type mode: str
+	:type segment: int
+	:returns: number of Gibbs steps
+	:rtype: int
+	"""
+	if mode == "sampling":
+		return 10
+	return 5 if segment*lines_per_segment + lines_per_segment-1 < 13 else 1
+
+
+def generate_batch(model, timelines, mode="feedback", k=None, sampler=None):
+	"""
+	Generates one song per emotion timeline, advancing all Gibbs chains together so each step is a single
+	matrix-matrix product over the chains. Passing the same timeline several times gives as many variations.
+	In feedback mode each segment starts from the previous segment's sample (as generate_feedback does), in
+	sampling mode from silence (as generate_sampling does). Timelines may have different lengths: a chain stops
+	when its timeline ends.
+
+	:param model: trained RBM
+	:param timelines: emotion values of each song, segments x 4 x 2 (see read_emotion_segments)
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:param k: number of Gibbs steps for every segment, by default the steps of the mode (see gibbs_steps)
+	:param sampler: sampler running the chains (see samplers.make_sampler), by default plain Gibbs sampling
+	:type model: rbm.NumpyRBM
+	:type timelines: list of numpy arrays
+	:type mode: str
+	:type k: int
+	:type sampler: samplers.Sampler
+	:returns: one matrix of timesteps x (2*note_range+2) per timeline
+	:rtype: list of numpy arrays
+	"""
+	width = 2*midi_manipulation.span+2
+	lengths = np.array([len(timeline) for timeline in timelines])
+	songs = [np.zeros((length*num_timesteps, width), np.float32) for length in lengths]
+	v = np.zeros((len(timelines), rbm.n_visible), np.float32)
+	for segment in range(lengths.max() if len(lengths) else 0):
+		chains = np.nonzero(lengths > segment)[0]
+		if mode == "sampling":
+			x_ = np.zeros((len(chains), rbm.n_visible), np.float32)
+		else:
+			x_ = v[chains]
+		clamp_emotions(x_, np.array([timelines[c][segment] for c in chains]))
+		steps = gibbs_steps(mode, segment) if k is None else k
+		if sampler is not None:
+			sample = sampler.sample(model, x_, steps, rbm.emotion_columns(), chains)
+		else:
+			sample = model.gibbs_sample(x_, steps, rbm.emotion_columns())
+		v[chains] = sample
+		for c, s in zip(chains, sample):
+			songs[c][segment*num_timesteps:(segment+1)*num_timesteps] = np.reshape(s, (num_timesteps, width))
+	return songs
+
+
+def emotion_lines(lines):
+	"""
+	Parses "arousal, valence" lines as they are read, e.g. from an open emotion text file or follow_emotion_file.
+
+	:param lines: lines of an emotion text file
+	:type lines: iterable of str
+	:returns: generator over (arousal, valence) pairs
+	:rtype: generator
+	"""
+	for line in lines:
+		if line.strip():
+			a, v = line.split(",")[:2]
+			yield float(a), float(v)
+
+
+def follow_emotion_file(emotion_text_file, is_done, poll_interval=0.5):
+	"""
+	Yields the lines of an emotion text file as they are written by another thread or process, until is_done returns
+	True and the whole file has been read.
+
+	:param emotion_text_file: path to text file holding emotion data
+	:param is_done: returns True once the writer has finished
+	:param poll_interval: seconds to wait before checking the file again, by default 0.5
+	:type emotion_text_file: str
+	:type is_done: function
+	:type poll_interval: float
+	:returns: generator over lines
+	:rtype: generator
+	"""
+	while not os.path.exists(emotion_text_file):
+		if is_done():
+			return
+		time.sleep(poll_interval)
+
+	with open(emotion_text_file) as f:
+		line = ''
+		while True:
+			data = f.readline()
+			line += data
+			if line.endswith("\n"):
+				yield line
+				line = ''
+			elif not data:
+				if is_done():
+					if line:
+						yield line
+					return
+				time.sleep(poll_interval)
+
+
+def generate_stream(model, emotions, mode="feedback", k=None, sampler=None):
+	"""
+	Generates music while the emotion values arrive, yielding each segment of 64 timesteps as soon as its 4 lines of
+	emotion values have been read. Only the current segment is kept, so memory use does not grow with the length of
+	the video.
+
+	:param model: trained RBM
+	:param emotions: (arousal, valence) pairs, e.g. from emotion_lines
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:param k: number of Gibbs steps for every segment, by default the steps of the mode (see gibbs_steps)
+	:param sampler: sampler running the chain (see samplers.make_sampler), by default plain Gibbs sampling
+	:type model: rbm.NumpyRBM
+	:type emotions: iterable
+	:type mode: str
+	:type k: int
+	:type sampler: samplers.Sampler
+	:returns: generator over matrices of 64 timesteps x (2*note_range+2)
+	:rtype: generator
+	"""
+	width = 2*midi_manipulation.span+2
+	v = np.zeros((1, rbm.n_visible), np.float32)
+	lines = []
+	segment = 0
+	for emotion in emotions:
+		lines.append(emotion)
+		if len(lines) < lines_per_segment:
+			continue
+		if mode == "sampling":
+			v = np.zeros((1, rbm.n_visible), np.float32)
+		else:
+			v = v.copy() # the previous segment has been handed out, leave it untouched
+		clamp_emotions(v, np.array([lines], np.float32))
+		steps = gibbs_steps(mode, segment) if k is None else k
+		if sampler is not None:
+			v = sampler.sample(model, v, steps, rbm.emotion_columns())
+		else:
+			v = model.gibbs_sample(v, steps, rbm.emotion_columns())
+		yield np.reshape(v, (num_timesteps, width))
+		lines = []
+		segment += 1
+
+
+def generate_stream_to_midi(model, emotions, midi_file_name, mode="feedback"):
+	"""
+	Generates music while the emotion values arrive (see generate_stream) and appends each segment to a midi file
+	as soon as it is generated.
+
+	:param model: trained RBM
+	:param emotions: (arousal, valence) pairs, e.g. from emotion_lines
+	:param midi_file_name: name for midi file
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:type model: rbm.NumpyRBM
+	:type emotions: iterable
+	:type midi_file_name: str
+	:type mode: str
+	:returns: number of segments generated
+	:rtype: int
+	"""
+	segments = 0
+	with midi_manipulation.StreamingMidiWriter(midi_file_name) as writer:
+		for segment in generate_stream(model, emotions, mode):
+			writer.write(segment)
+			segments += 1
+	return segments
+
+
+def model_hash(model):
+	"""
+	Returns a digest of the weights and biases of a model, identifying it in segment cache keys.
+
+	:param model: RBM
+	:type model: rbm.NumpyRBM
+	:returns: hexadecimal sha1 digest
+	:rtype: str
+	"""
+	digest = hashlib.sha1()
+	for param in (model.W, model.bh, model.bv):
+		digest.update(np.ascontiguousarray(param).tobytes())
+	return digest.hexdigest()
+
+
+class SegmentCache(object):
+	"""
+	Size-bounded cache of generated segments, keyed by segment_key. The most recently used segments are kept in
+	memory, and with a cache folder every segment is also written there as a CompactSong .npz file, so later runs
+	and other processes reuse them. When either bound is exceeded, the least recently used segments are evicted; on
+	disk down to three quarters of the bound, so the folder is only listed once in a while rather than on every
+	write. Safe to share between threads.
+	"""
+
+	def __init__(self, max_entries=1024, cache_dir=None, max_disk_bytes=256*1024*1024):
+		"""
+		:param max_entries: number of segments kept in memory, by default 1024
+		:param cache_dir: folder the segments are written to, by default memory only
+		:param max_disk_bytes: size of the cache folder, by default 256MB
+		:type max_entries: int
+		:type cache_dir: str
+		:type max_disk_bytes: int
+		"""
+		self.max_entries = max_entries
+		self.cache_dir = cache_dir
+		self.max_disk_bytes = max_disk_bytes
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.disk_bytes = None # size of the cache folder, measured on the first write and then counted
+		if cache_dir is not None and not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def file_name(self, key):
+		return os.path.join(self.cache_dir, "{}.npz".format(key))
+
+	def get(self, key):
+		"""
+		Returns the cached segment of a key, or None.
+
+		:param key: segment key
+		:type key: str
+		:returns: visible vector of the segment, 1 x n_visible
+		:rtype: numpy array of float32
+		"""
+		with self.lock:
+			segment = self.entries.pop(key, None)
+			if segment is None and self.cache_dir is not None and os.path.exists(self.file_name(key)):
+				segment = compact_song.CompactSong.load(self.file_name(key))
+			if segment is not None and self.cache_dir is not None:
+				self.touch(key)
+			if segment is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.remember(key, segment)
+		return np.reshape(segment.to_matrix(), (1, -1))
+
+	def put(self, key, sample):
+		"""
+		Stores a generated segment.
+
+		:param key: segment key
+		:param sample: visible vector of the segment, 1 x n_visible
+		:type key: str
+		:type sample: numpy array
+		:returns: None
+		:rtype: None
+		"""
+		segment = compact_song.CompactSong.from_matrix(np.reshape(sample, (num_timesteps, -1)))
+		with self.lock:
+			self.remember(key, segment)
+			if self.cache_dir is not None:
+				# other processes may share the folder, and thread idents are only unique within a process
+				temp_file = "{}.{}.{}.tmp".format(self.file_name(key), os.getpid(), threading.current_thread().ident)
+				with open(temp_file, 'wb') as f:
+					segment.save(f)
+				size = os.path.getsize(temp_file)
+				if self.disk_bytes is None:
+					self.disk_bytes = self.folder_size()
+				if os.path.exists(self.file_name(key)):
+					size -= os.path.getsize(self.file_name(key))
+				os.rename(temp_file, self.file_name(key))
+				self.disk_bytes += size
+				if self.disk_bytes > self.max_disk_bytes:
+					self.evict_from_disk()
+
+	def remember(self, key, segment):
+		self.entries[key] = segment
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def touch(self, key):
+		"""
+		Marks the file of a segment as recently used, so that segments served from memory are not evicted from disk
+		as if they were stale.
+		"""
+		try:
+			os.utime(self.file_name(key), None)
+		except OSError:
+			pass # not written yet, or evicted by another process
+
+	def segment_files(self):
+		"""
+		:returns: modification time, size and path of every segment file of the cache folder
+		:rtype: list of tuple
+		"""
+		files = []
+		for f in os.listdir(self.cache_dir):
+			if f.endswith(".npz"):
+				f = os.path.join(self.cache_dir, f)
+				try:
+					files.append((os.path.getmtime(f), os.path.getsize(f), f))
+				except OSError:
+					pass # evicted by another process meanwhile
+		return files
+
+	def folder_size(self):
+		return sum(size for _, size, _ in self.segment_files())
+
+	def evict_from_disk(self):
+		"""
+		Deletes the least recently used segment files until the cache folder fits in three quarters of max_disk_bytes.
+		The folder is listed again, as other processes may have written to it.
+
+		:returns: None
+		:rtype: None
+		"""
+		files = sorted(self.segment_files())
+		total = sum(size for _, size, _ in files)
+		for _, size, f in files:
+			if total <= self.max_disk_bytes*3//4:
+				break
+			try:
+				os.remove(f)
+			except OSError:
+				pass
+			total -= size
+		self.disk_bytes = total
+
+
+def segment_key(emotions, mode, k, seed, model_key, previous_key=""):
+	"""
+	Returns the key of a generated segment: a digest of everything the segment depends on when generating
+	deterministically (see generate_deterministic). In feedback mode a segment starts from the previous one, so the
+	previous segment's key is part of it.
+
+	:param emotions: quantized emotion values of the segment, 4 x 2 integers
+	:param mode: "feedback" or "sampling"
+	:param k: number of Gibbs steps
+	:param seed: seed of the song
+	:param model_key: hash of the model (see model_hash)
+	:param previous_key: key of the previous segment in feedback mode, by default none
+	:type emotions: numpy array of int
+	:type mode: str
+	:type k: int
+	:type seed: int
+	:type model_key: str
+	:type previous_key: str
+	:returns: hexadecimal sha1 digest
+	:rtype: str
+	"""
+	parts = (tuple(np.ravel(emotions).tolist()), mode, k, seed, model_key, previous_key)
+	return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def generate_deterministic(model, timeline, mode="feedback", k=None, seed=0, cache=None, quantum=0.05,
+						   model_key=None):
+	"""
+	Generates a song that only depends on the emotion timeline, mode, Gibbs steps, seed and model. Emotion values are
+	rounded to multiples of quantum, and each segment samples with a random number generator seeded from its
+	segment_key, so a segment can be taken from the cache instead of being generated again whenever the same key comes
+	up: in sampling mode for any segment with the same quantized emotions, in feedback mode for any song starting
+	with the same quantized segments.
+
+	:param model: trained RBM
+	:param timeline: emotion values, segments x 4 x 2 (see read_emotion_segments)
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:param k: number of Gibbs steps for every segment, by default the steps of the mode (see gibbs_steps)
+	:param seed: seed of the song, by default 0
+	:param cache: cache of generated segments, by default none
+	:param quantum: step the emotion values are rounded to, by default 0.05
+	:param model_key: hash of the model (see model_hash), by default computed here. Callers generating many songs
+					  with the same weights, such as the generation server, compute it once and pass it
+	:type model: rbm.NumpyRBM
+	:type timeline: numpy array
+	:type mode: str
+	:type k: int
+	:type seed: int
+	:type cache: SegmentCache
+	:type quantum: float
+	:type model_key: str
+	:returns: matrix of timesteps x (2*note_range+2)
+	:rtype: numpy array of float32
+	"""
+	width = 2*midi_manipulation.span+2
+	if model_key is None:
+		model_key = model_hash(model)
+	song = np.zeros((len(timeline)*num_timesteps, width), np.float32)
+	v = np.zeros((1, rbm.n_visible), np.float32)
+	key = ""
+	for segment, emotions in enumerate(timeline):
+		quantized = np.round(np.asarray(emotions) / quantum).astype(int)
+		steps = gibbs_steps(mode, segment) if k is None else k
+		key = segment_key(quantized, mode, steps, seed, model_key, key if mode == "feedback" else "")
+		sample = cache.get(key) if cache is not None else None
+		if sample is None:
+			x_ = np.zeros((1, rbm.n_visible), np.float32) if mode == "sampling" else v.copy()
+			clamp_emotions(x_, (quantized*quantum).astype(np.float32)[np.newaxis])
+			model.rng.seed(int(key[:8], 16))
+			sample = model.gibbs_sample(x_, steps, rbm.emotion_columns())
+			if cache is not None:
+				cache.put(key, sample)
+		v = sample
+		song[segment*num_timesteps:(segment+1)*num_timesteps] = np.reshape(sample, (num_timesteps, width))
+	return song
+
+
+def main():
+	"""
+	Generates several songs at once with the NumPy RBM engine, one per emotion text file and variation, and saves
+	each as a midi file named <output>_<file number>_<variation>.mid.
+
+	This method is run through the command-line interface
+	:param emotion_text_files: paths to text files holding emotion data
+	:param output: prefix of the midi file names
+	:param variations: number of songs generated per emotion text file, by default 1
+	:param mode: "feedback" or "sampling", by default "feedback"
+	:param model: path to the trained model, by default parameter_checkpoints/trained_system
+	:param seed: seed of the random number generator, by default random
+	:param cache_dir: folder of the segment cache, generates deterministically (requires a seed), by default no cache
+	:param sampler: "gibbs", "persistent", "annealed" or "tempering" (see samplers.make_sampler), by default "gibbs"
+	:returns: None
+	:rtype: None
+	"""
+	parser = argparse.ArgumentParser()
+	parser.add_argument("emotion_text_files", help="Text files holding emotion data", type=str, nargs="+")
+	parser.add_argument("--output", help="Prefix of the midi file names", type=str, default="generated")
+	parser.add_argument("--variations", help="Number of songs generated per emotion text file", type=int, default=1)
+	parser.add_argument("--mode", help="RBM generator: feedback or sampling", choices=modes, default="feedback")
+	parser.add_argument("--model", help="Trained model (.npz or TensorFlow checkpoint)", type=str,
+						default="parameter_checkpoints/trained_system")
+	parser.add_argument("--seed", help="Seed of the random number generator", type=int, default=None)
+	parser.add_argument("--cache-dir", help="Folder of the segment cache, generates deterministically (requires a seed)",
+						type=str, default=None)
+	parser.add_argument("--sampler", help="Sampler running the Gibbs chains", choices=samplers.sampler_names,
+						default="gibbs")
+	args = parser.parse_args()
+	if args.cache_dir is not None and args.seed is None:
+		parser.error("--cache-dir requires --seed")
+	if args.cache_dir is not None and args.sampler != "gibbs":
+		parser.error("--cache-dir only supports the gibbs sampler")
+
+	model = load_model(args.model, args.seed)
+	timelines = []
+	names = []
+	for f, emotion_text_file in enumerate(args.emotion_text_files):
+		segments = read_emotion_segments(emotion_text_file)
+		for variation in range(args.variations):
+			timelines.append(segments)
+			names.append("{}_{}_{}".format(args.output, f, variation))
+
+	if args.cache_dir is not None:
+		# each variation is a different seed, so repeated runs give the same files and reuse cached segments
+		cache = SegmentCache(cache_dir=args.cache_dir)
+		songs = [generate_deterministic(model, timeline, args.mode, seed=args.seed + n % args.variations, cache=cache)
+				 for n, timeline in enumerate(timelines)]
+		print "{} segments from the cache, {} generated".format(cache.hits, cache.misses)
+	else:
+		sampler = None if args.sampler == "gibbs" else samplers.make_sampler(args.sampler)
+		songs = generate_batch(model, timelines, args.mode, sampler=sampler)
+	for song, name in zip(songs, names):
+		midi_manipulation.noteStateMatrixToMidi(song, name)
+	print "{} midi files generated".format(len(songs))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,184 @@
+import glob
+import json
+import os
+import re
+import numpy as np
+
+
+def state_file(checkpoint_path):
+    """
+    Returns the path of the run state saved next to a checkpoint
+
+    :param checkpoint_path: path to the checkpoint, e.g. "parameter_checkpoints/epoch-4"
+    :type checkpoint_path: str
+    :returns: path to the .state.json file
+    :rtype: str
+    """
+    return "{}.state.json".format(checkpoint_path)
+
+
+def save_run_state(checkpoint_path, epoch, rng, hyperparameters, progress=None):
+    """
+    Saves what a training run needs to continue from a checkpoint besides the weights and biases: the number of
+    epochs completed, the state of the random number generator that orders the training data, the
+    hyperparameters of the run, and its progress (e.g. the state of training_metrics.EarlyStopping).
+
+    :param checkpoint_path: path to the checkpoint the state belongs to
+    :param epoch: number of epochs completed
+    :param rng: random number generator ordering the training data
+    :param hyperparameters: settings of the run, by name
+    :param progress: anything else needed to continue the run, by name, by default nothing
+    :type checkpoint_path: str
+    :type epoch: int
+    :type rng: numpy RandomState
+    :type hyperparameters: dict
+    :type progress: dict
+    :returns: None
+    :rtype: None
+    """
+    algorithm, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    state = {
+        "epoch": epoch,
+        "rng": [algorithm, keys.tolist(), pos, has_gauss, cached_gaussian],
+        "hyperparameters": hyperparameters,
+        "progress": progress or {},
+    }
+    # write to a temporary file first so a run stopped while saving never leaves a truncated state behind
+    temp_file = "{}.{}.tmp".format(state_file(checkpoint_path), os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(temp_file, state_file(checkpoint_path))
+
+
+def load_run_state(checkpoint_path):
+    """
+    Reads the run state saved with a checkpoint (see save_run_state)
+
+    :param checkpoint_path: path to the checkpoint
+    :type checkpoint_path: str
+    :returns: number of epochs completed, random number generator in its saved state, and hyperparameters
+    :rtype: tuple
+    """
+    with open(state_file(checkpoint_path)) as f:
+        state = json.load(f)
+    algorithm, keys, pos, has_gauss, cached_gaussian = state["rng"]
+    rng = np.random.RandomState()
+    rng.set_state((str(algorithm), np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    return state["epoch"], rng, state["hyperparameters"]
+
+
+def load_progress(checkpoint_path):
+    """
+    Reads the progress saved with a checkpoint (see save_run_state)
+
+    :param checkpoint_path: path to the checkpoint
+    :type checkpoint_path: str
+    :returns: progress by name, empty if none was saved
+    :rtype: dict
+    """
+    with open(state_file(checkpoint_path)) as f:
+        return json.load(f).get("progress", {})
+
+
+def epoch_checkpoints(directory, prefix="epoch"):
+    """
+    Returns the epoch checkpoints of a folder that have a run state, in order of epochs.
+
+    :param directory: folder holding the checkpoints
+    :param prefix: name of the checkpoints before "-<epoch>", by default "epoch"
+    :type directory: str
+    :type prefix: str
+    :returns: (epoch, checkpoint path) pairs
+    :rtype: list of tuple
+    """
+    checkpoints = []
+    pattern = re.compile(r"{}-(\d+)\.state\.json$".format(re.escape(prefix)))
+    for f in glob.glob(os.path.join(directory, "{}-*.state.json".format(prefix))):
+        match = pattern.search(os.path.basename(f))
+        if match:
+            checkpoints.append((int(match.group(1)), f[:-len(".state.json")]))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(directory, prefix="epoch"):
+    """
+    Returns the epoch checkpoint of a folder that was saved last and has a run state.
+
+    :param directory: folder holding the checkpoints
+    :param prefix: name of the checkpoints before "-<epoch>", by default "epoch"
+    :type directory: str
+    :type prefix: str
+    :returns: path to the checkpoint, None if there is none
+    :rtype: str
+    """
+    checkpoints = epoch_checkpoints(directory, prefix)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+def prune_checkpoints(directory, keep_last=3, keep_every=25, prefix="epoch"):
+    """
+    Deletes the epoch checkpoints of a folder, with their run states, except the keep_last most recent ones and
+    those saved at the end of every keep_every epochs.
+
+    :param directory: folder holding the checkpoints
+    :param keep_last: number of most recent checkpoints kept, by default 3
+    :param keep_every: checkpoints of epochs that are a multiple of this are kept, 0 to keep none, by default 25
+    :param prefix: name of the checkpoints before "-<epoch>", by default "epoch"
+    :type directory: str
+    :type keep_last: int
+    :type keep_every: int
+    :type prefix: str
+    :returns: paths to the checkpoints deleted
+    :rtype: list
+    """
+    checkpoints = epoch_checkpoints(directory, prefix)
+    deleted = []
+    for epoch, checkpoint_path in checkpoints[:max(len(checkpoints) - keep_last, 0)]:
+        if keep_every and (epoch + 1) % keep_every == 0:
+            continue
+        remove_checkpoint(checkpoint_path)
+        deleted.append(checkpoint_path)
+    return deleted
+
+
+def prune_best_checkpoints(directory, keep, prefix="best", epoch_prefix="epoch"):
+    """
+    Deletes the checkpoints of the best model of a folder (named "<prefix>-<epoch>"), except keep and those named by
+    the early stopping state of its remaining epoch checkpoints, which a run resumed from them restores at the end.
+
+    :param directory: folder holding the checkpoints
+    :param keep: path to the checkpoint of the best model of the current run
+    :param prefix: name of the best checkpoints before "-<epoch>", by default "best"
+    :param epoch_prefix: name of the epoch checkpoints before "-<epoch>", by default "epoch"
+    :type directory: str
+    :type keep: str
+    :type prefix: str
+    :type epoch_prefix: str
+    :returns: paths to the checkpoints deleted
+    :rtype: list
+    """
+    referenced = set([os.path.normpath(keep)])
+    for _, checkpoint_path in epoch_checkpoints(directory, epoch_prefix):
+        best_checkpoint = load_progress(checkpoint_path).get("early_stopping", {}).get("best_checkpoint")
+        if best_checkpoint is not None:
+            referenced.add(os.path.normpath(best_checkpoint))
+    deleted = []
+    for _, checkpoint_path in epoch_checkpoints(directory, prefix):
+        if os.path.normpath(checkpoint_path) not in referenced:
+            remove_checkpoint(checkpoint_path)
+            deleted.append(checkpoint_path)
+    return deleted
+
+
+def remove_checkpoint(checkpoint_path):
+    """
+    Deletes a checkpoint: every file whose name is the checkpoint path, or starts with it followed by a dot
+    (e.g. .meta, .npz and the .state.json of its run state).
+
+    :param checkpoint_path: path to the checkpoint
+    :type checkpoint_path: str
+    :returns: None
+    :rtype: None
+    """
+    for f in glob.glob(checkpoint_path) + glob.glob("{}.*".format(checkpoint_path)):
+        os.remove(f)
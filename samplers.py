@@ -0,0 +1,304 @@
+import argparse
+import numpy as np
+import rbm
+
+
+sampler_names = ("gibbs", "persistent", "annealed", "tempering")
+
+
+class Sampler(object):
+	"""
+	Runs the Gibbs chains of one segment of generation. Each chain may have several replicas, each sampling the RBM at
+	an inverse temperature beta: the pre-activations are multiplied by beta, so beta=1 is the model itself and lower
+	values flatten it, letting the chain move more freely between modes. The beta=1 replica is the one returned.
+
+	With persistent set, the replicas of each chain are kept at the end of a segment and the chain's next segment
+	starts from them, with the new emotion values clamped, instead of from the visible vector passed in.
+
+	With record set, the note density and free energy of the returned replicas are recorded in trace after every
+	step, together with the number of matrix products run per chain so far (see quality_report).
+	"""
+
+	def __init__(self, persistent=False, record=False):
+		"""
+		:param persistent: carry the replicas of each chain across segments, by default False
+		:param record: record quality metrics after every step, by default False
+		:type persistent: bool
+		:type record: bool
+		"""
+		self.persistent = persistent
+		self.record = record
+		self.states = {}
+		self.trace = []
+		self.segment = 0
+
+	def betas(self, k):
+		"""
+		Returns the inverse temperature of every replica at every step, the last replica being the one returned.
+
+		:param k: number of Gibbs steps
+		:type k: int
+		:returns: matrix of steps x replicas
+		:rtype: numpy array of float32
+		"""
+		return np.ones((k, 1), np.float32)
+
+	def exchange(self, model, v, pre, h, betas, chains):
+		"""
+		Called after every hidden half-step with the visible values, their hidden pre-activations (before beta) and
+		the hidden values sampled, replicas stacked by rows. Returns the hidden values to continue from.
+
+		:returns: hidden values
+		:rtype: numpy array
+		"""
+		return h
+
+	def sample(self, model, v, k, clamp_columns=None, chains=None):
+		"""
+		Runs k Gibbs steps from each row of v and returns the beta=1 replica of each chain.
+
+		:param model: trained RBM
+		:param v: visible values the chains start from, one row per chain
+		:param k: number of Gibbs steps
+		:param clamp_columns: indices of the visible nodes to clamp, by default none
+		:param chains: identifier of each row, used to find its persistent replicas, by default the row index
+		:type model: rbm.NumpyRBM
+		:type v: numpy array
+		:type k: int
+		:type clamp_columns: numpy array of int
+		:type chains: list of int
+		:returns: visible values sampled, one row per chain
+		:rtype: numpy array of float32
+		"""
+		v = np.asarray(v, dtype=np.float32)
+		if chains is None:
+			chains = range(len(v))
+		n = len(v)
+		betas = self.betas(k)
+		x = np.repeat(v[np.newaxis], betas.shape[1], axis=0) # replicas x chains x n_visible
+		if self.persistent:
+			for i, c in enumerate(chains):
+				if c in self.states:
+					x[:, i] = self.states[c]
+		if clamp_columns is not None:
+			x[:, :, clamp_columns] = v[:, clamp_columns]
+			clamped = np.reshape(x[:, :, clamp_columns], (-1, len(clamp_columns)))
+		x = np.reshape(x, (-1, v.shape[1]))
+
+		for step in range(k):
+			beta = np.repeat(betas[step], n)[:, np.newaxis]
+			pre = np.dot(x, model.W)
+			pre += model.bh
+			h = model.sample(model.sigmoid(beta*pre)) # Propagate the visible values to sample the hidden values
+			h = self.exchange(model, x, pre, h, betas[step], n)
+			x = np.dot(h, model.W.T)
+			x += model.bv
+			x *= beta
+			x = model.sample(model.sigmoid(x)) # Propagate the hidden values to sample the visible values
+			if clamp_columns is not None:
+				x[:, clamp_columns] = clamped
+			if self.record:
+				self.record_step(model, x[-n:], step + 1, 2*(step + 1)*len(betas[step]), clamp_columns)
+
+		x = np.reshape(x, (-1, n, v.shape[1]))
+		if self.persistent:
+			for i, c in enumerate(chains):
+				self.states[c] = x[:, i].copy()
+		self.segment += 1
+		return x[-1]
+
+	def record_step(self, model, v, step, matmuls, clamp_columns):
+		"""
+		Appends the quality of the returned replicas after a step to trace: the fraction of note nodes on and the mean
+		free energy (see rbm.NumpyRBM.free_energy).
+
+		:returns: None
+		:rtype: None
+		"""
+		notes = np.ones(v.shape[1], bool)
+		if clamp_columns is not None:
+			notes[clamp_columns] = False
+		self.trace.append({
+			"segment": self.segment,
+			"step": step,
+			"matmuls": matmuls,
+			"density": float(v[:, notes].mean()),
+			"free_energy": float(model.free_energy(v).mean()),
+		})
+
+
+class GibbsSampler(Sampler):
+	"""
+	Plain Gibbs sampling of the model, one replica per chain. Persistent, each segment continues the chain of the
+	previous one, which in sampling mode replaces the restart from silence.
+	"""
+
+
+class AnnealedSampler(Sampler):
+	"""
+	Gibbs sampling with the inverse temperature raised linearly from beta_start at the first step to 1 at the last,
+	so the chain starts from a flattened model and settles into the model itself.
+	"""
+
+	def __init__(self, beta_start=0.8, persistent=False, record=False):
+		"""
+		:param beta_start: inverse temperature of the first step, by default 0.8
+		:param persistent: carry the chain across segments, by default False
+		:param record: record quality metrics after every step, by default False
+		:type beta_start: float
+		:type persistent: bool
+		:type record: bool
+		"""
+		Sampler.__init__(self, persistent, record)
+		self.beta_start = beta_start
+
+	def betas(self, k):
+		if k == 1:
+			return np.ones((1, 1), np.float32)
+		return np.linspace(self.beta_start, 1, k).astype(np.float32)[:, np.newaxis]
+
+
+class TemperingSampler(Sampler):
+	"""
+	Parallel tempering: every chain runs replicas at inverse temperatures spaced evenly from beta_min to 1. After each
+	hidden half-step, neighbouring replicas (even pairs, then odd pairs on the next step) swap states with the
+	Metropolis probability min(1, exp((beta_i - beta_j)*(E_i - E_j))) of the joint energy E(v, h), so states found by
+	the hot replicas reach the beta=1 replica. Each step costs a matrix product per replica.
+
+	The energies of a 10112-node visible layer are large, so the temperatures have to be close for swaps to be
+	accepted: with a trained model, 4 replicas from 0.95 accept about half of the swaps, from 0.4 none.
+	"""
+
+	def __init__(self, replicas=4, beta_min=0.95, persistent=True, record=False):
+		"""
+		:param replicas: number of replicas per chain, including the beta=1 one, by default 4
+		:param beta_min: inverse temperature of the hottest replica, by default 0.95
+		:param persistent: carry the replicas across segments, by default True
+		:param record: record quality metrics after every step, by default False
+		:type replicas: int
+		:type beta_min: float
+		:type persistent: bool
+		:type record: bool
+		"""
+		Sampler.__init__(self, persistent, record)
+		self.replicas = replicas
+		self.beta_min = beta_min
+		self.swaps = 0
+		self.swaps_attempted = 0
+		self.parity = 0
+
+	def betas(self, k):
+		return np.tile(np.linspace(self.beta_min, 1, self.replicas).astype(np.float32), (k, 1))
+
+	def exchange(self, model, v, pre, h, betas, chains):
+		energy = -np.dot(v, model.bv[0]) - (h*pre).sum(axis=1)
+		energy = np.reshape(energy, (-1, chains))
+		h = np.reshape(h, (-1, chains, h.shape[1]))
+		for r in range(self.parity, len(betas) - 1, 2):
+			log_accept = (betas[r] - betas[r + 1])*(energy[r] - energy[r + 1])
+			swap = np.log(model.rng.random_sample(chains)) < log_accept
+			h[r, swap], h[r + 1, swap] = h[r + 1, swap], h[r, swap].copy()
+			self.swaps += int(swap.sum())
+			self.swaps_attempted += chains
+		self.parity = 1 - self.parity
+		return np.reshape(h, (-1, h.shape[2]))
+
+
+def make_sampler(name, record=False):
+	"""
+	Returns a sampler with its default settings.
+
+	:param name: "gibbs", "persistent" (persistent Gibbs), "annealed" or "tempering"
+	:param record: record quality metrics after every step, by default False
+	:type name: str
+	:type record: bool
+	:returns: sampler
+	:rtype: Sampler
+	"""
+	if name == "gibbs":
+		return GibbsSampler(record=record)
+	if name == "persistent":
+		return GibbsSampler(persistent=True, record=record)
+	if name == "annealed":
+		return AnnealedSampler(record=record)
+	if name == "tempering":
+		return TemperingSampler(record=record)
+	raise ValueError("unknown sampler {}".format(name))
+
+
+def quality_report(trace):
+	"""
+	Averages the metrics recorded by a sampler over segments and chains, step by step.
+
+	:param trace: metrics recorded by a sampler (see Sampler.record_step)
+	:type trace: list of dict
+	:returns: one row per step holding step, matmuls, density and free_energy, in order of steps
+	:rtype: list of dict
+	"""
+	steps = {}
+	for entry in trace:
+		steps.setdefault(entry["step"], []).append(entry)
+	report = []
+	for step in sorted(steps):
+		entries = steps[step]
+		report.append({
+			"step": step,
+			"matmuls": entries[0]["matmuls"],
+			"density": float(np.mean([e["density"] for e in entries])),
+			"free_energy": float(np.mean([e["free_energy"] for e in entries])),
+		})
+	return report
+
+
+def main():
+	"""
+	Generates music for an emotion text file with each sampler, recording the note density and free energy after
+	every Gibbs step, and prints how they change with the number of steps and of matrix products per segment.
+
+	This method is run through the command-line interface
+	:param emotion_text_file: path to text file holding emotion data
+	:param model: path to the trained model, by default parameter_checkpoints/trained_system
+	:param steps: number of Gibbs steps per segment, by default 10
+	:param chains: number of songs generated per sampler, by default 4
+	:param mode: "feedback" or "sampling", by default "sampling"
+	:param target_density: fraction of note nodes on that counts as usable, by default 0.02
+	:param seed: seed of the random number generator, by default 0
+	:returns: None
+	:rtype: None
+	"""
+	import rbm_generation
+	parser = argparse.ArgumentParser()
+	parser.add_argument("emotion_text_file", help="Text file holding emotion data", type=str)
+	parser.add_argument("--model", help="Trained model (.npz or TensorFlow checkpoint)", type=str,
+						default="parameter_checkpoints/trained_system")
+	parser.add_argument("--steps", help="Number of Gibbs steps per segment", type=int, default=10)
+	parser.add_argument("--chains", help="Number of songs generated per sampler", type=int, default=4)
+	parser.add_argument("--mode", help="RBM generator: feedback or sampling", choices=rbm_generation.modes,
+						default="sampling")
+	parser.add_argument("--target-density", help="Fraction of note nodes on that counts as usable", type=float,
+						default=0.02)
+	parser.add_argument("--seed", help="Seed of the random number generator", type=int, default=0)
+	args = parser.parse_args()
+
+	model = rbm_generation.load_model(args.model)
+	timeline = rbm_generation.read_emotion_segments(args.emotion_text_file)
+	print "{:<11} {:>5} {:>8} {:>8} {:>12}".format("sampler", "step", "matmuls", "density", "free energy")
+	for name in sampler_names:
+		model.rng.seed(args.seed)
+		sampler = make_sampler(name, record=True)
+		rbm_generation.generate_batch(model, [timeline]*args.chains, args.mode, args.steps, sampler)
+		report = quality_report(sampler.trace)
+		for row in report:
+			print "{:<11} {:>5} {:>8} {:>8.4f} {:>12.2f}".format(name, row["step"], row["matmuls"], row["density"],
+																  row["free_energy"])
+		usable = [row for row in report if row["density"] >= args.target_density]
+		if usable:
+			print "{}: density {} reached after {} steps ({} matrix products per chain and segment)".format(
+				name, args.target_density, usable[0]["step"], usable[0]["matmuls"])
+		else:
+			print "{}: density {} not reached".format(name, args.target_density)
+		if isinstance(sampler, TemperingSampler) and sampler.swaps_attempted:
+			print "{}: {:.0%} of replica swaps accepted".format(name, sampler.swaps/float(sampler.swaps_attempted))
+
+if __name__ == "__main__":
+	main()
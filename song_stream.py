@@ -0,0 +1,269 @@
+import glob
+import multiprocessing
+import sys
+import threading
+import numpy as np
+import midi_manipulation
+
+
+def shuffled(items, buffer_size, rng=np.random):
+    """
+    Shuffles a stream of items while holding at most buffer_size of them in memory. The buffer is filled first,
+    then each new item replaces a randomly chosen item of the buffer, which is yielded.
+
+    :param items: stream of items
+    :param buffer_size: number of items held in the buffer, 1 or less leaves the stream unchanged
+    :param rng: random number generator, by default numpy's global one
+    :type items: iterable
+    :type buffer_size: int
+    :type rng: numpy RandomState
+    :returns: generator over the items in shuffled order
+    :rtype: generator
+    """
+    if buffer_size <= 1:
+        for item in items:
+            yield item
+        return
+
+    buf = []
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        i = rng.randint(len(buf))
+        yield buf[i]
+        buf[i] = item
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def batched(items, batch_size):
+    """
+    Groups a stream of equally sized vectors into matrices of batch_size rows. The last batch holds the remaining
+    vectors and may be smaller.
+
+    :param items: stream of vectors
+    :param batch_size: number of rows per batch
+    :type items: iterable
+    :type batch_size: int
+    :returns: generator over matrices of batch x vector size
+    :rtype: generator
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield np.vstack(batch)
+            batch = []
+    if batch:
+        yield np.vstack(batch)
+
+
+def prefetched(items, function=None, buffer_size=4, workers=1):
+    """
+    Prepares a stream of items in background threads while the caller works on the items already prepared, e.g.
+    expands and augments the next batches while an update runs. Each thread takes the next item of the stream,
+    applies function to it and holds the result until the caller reaches it, so the items keep their order. At most
+    buffer_size items are taken ahead of the caller: once that many wait, the threads block until the caller takes
+    one, so a slow caller never makes the stream run ahead or fill memory. Exceptions raised by the stream or by
+    function are raised again to the caller at the item that raised them.
+
+    :param items: stream of items
+    :param function: function applied to each item, by default none
+    :param buffer_size: number of items prepared ahead of the caller, 0 prepares each item when the caller asks for it
+    :param workers: number of threads preparing items, by default 1
+    :type items: iterable
+    :type function: function
+    :type buffer_size: int
+    :type workers: int
+    :returns: generator over the prepared items, in the order of the stream
+    :rtype: generator
+    """
+    if function is None:
+        function = lambda item: item
+    if buffer_size <= 0:
+        for item in items:
+            yield function(item)
+        return
+
+    items = iter(items)
+    take_lock = threading.Lock()      # the stream is read by one thread at a time
+    ready = threading.Condition()     # guards results and end
+    slots = threading.Semaphore(buffer_size)
+    stopped = threading.Event()
+    results = {}
+    state = {"taken": 0, "end": None} # end is the number of items in the stream, once known
+
+    def work():
+        while True:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            with take_lock:
+                i = state["taken"]
+                if state["end"] is not None:
+                    return
+                try:
+                    item = next(items)
+                except StopIteration:
+                    with ready:
+                        state["end"] = i
+                        ready.notify_all()
+                    return
+                except Exception:
+                    with ready:
+                        results[i] = (False, sys.exc_info())
+                        state["end"] = i + 1
+                        ready.notify_all()
+                    return
+                state["taken"] = i + 1
+            try:
+                result = (True, function(item))
+            except Exception:
+                result = (False, sys.exc_info())
+            with ready:
+                results[i] = result
+                ready.notify_all()
+
+    threads = [threading.Thread(target=work) for _ in range(max(workers, 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        i = 0
+        while True:
+            with ready:
+                while i not in results and (state["end"] is None or i < state["end"]):
+                    ready.wait()
+                if i not in results:
+                    return
+                ok, result = results.pop(i)
+            slots.release()
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+            i += 1
+    finally:
+        # the caller is done, possibly before the end of the stream: wake the threads waiting for a slot so they exit
+        stopped.set()
+        for _ in threads:
+            slots.release()
+
+
+class SongStream(object):
+    """
+    Iterates lazily over the songs in a folder of midi files, reading one song at a time from disk (or from the song
+    cache, see midi_manipulation.get_cached_song) so memory use does not depend on the size of the corpus. Every
+    iteration goes through the folder again, so the same stream can be used for every epoch, and picks up files added
+    since the last one.
+
+    With num_timesteps set, the stream yields sections of num_timesteps instead of songs, each flattened into one
+    visible vector of the RBM (see CompactSong.chunks).
+
+    With more than one worker, the stream starts a process pool on its first iteration and reuses it for every
+    later one; call close (or use the stream in a with statement) to stop it.
+    """
+
+    def __init__(self, path, cache_dir=None, num_timesteps=None, shuffle_buffer=0, seed=None, workers=1,
+                 chunksize=4, min_timesteps=50, files=None):
+        """
+        :param path: path to a folder containing midi files and their emotion text files
+        :param cache_dir: folder holding preprocessed songs, by default no cache
+        :param num_timesteps: number of timesteps per section, by default whole songs are yielded
+        :param shuffle_buffer: number of songs (or sections) held to shuffle the stream, by default 0 (no shuffling)
+        :param seed: seed for the order of files and shuffling, by default random
+        :param workers: number of processes transforming files in parallel, by default 1 (no process pool)
+        :param chunksize: number of files sent to a worker process at a time, by default 4
+        :param min_timesteps: songs with this many timesteps or fewer are left out, by default 50
+        :param files: midi files to use instead of every file in the folder (e.g. from manifest.select)
+        :type path: str
+        :type cache_dir: str
+        :type num_timesteps: int
+        :type shuffle_buffer: int
+        :type seed: int
+        :type workers: int
+        :type chunksize: int
+        :type min_timesteps: int
+        :type files: list
+        """
+        self.path = path
+        self.cache_dir = cache_dir
+        self.num_timesteps = num_timesteps
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.RandomState(seed)
+        self.workers = workers
+        self.chunksize = chunksize
+        self.min_timesteps = min_timesteps
+        self.selected_files = files
+        self.pool = None
+        self.skipped = {} # error of every file skipped so far, by path, so each is reported once
+
+    def files(self):
+        """
+        Returns the midi files of the folder, in shuffled order when shuffling.
+
+        :returns: paths to midi files
+        :rtype: list
+        """
+        if self.selected_files is not None:
+            files = list(self.selected_files)
+        else:
+            files = sorted(glob.glob('{}/*.mid*'.format(self.path)))
+        if self.shuffle_buffer > 1:
+            self.rng.shuffle(files)
+        return files
+
+    def songs(self):
+        """
+        Yields each song of the folder as a CompactSong, skipping files that cannot be transformed. A skipped file is
+        reported the first time it fails, not again on every iteration. With more than one worker, files are
+        transformed in the stream's process pool a window of a few chunks at a time, so results never pile up faster
+        than they are consumed.
+
+        :returns: generator over CompactSongs
+        :rtype: generator
+        """
+        jobs = [(f, self.cache_dir, True) for f in self.files()]
+        if self.workers > 1:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers)
+            window = 2*self.workers*self.chunksize
+            results = (result for start in range(0, len(jobs), window)
+                       for result in self.pool.imap(midi_manipulation.load_song, jobs[start:start+window],
+                                                    self.chunksize))
+        else:
+            results = (midi_manipulation.load_song(job) for job in jobs)
+
+        for f, song, error in results:
+            if error is not None:
+                if self.skipped.get(f) != error:
+                    print "Skipped {} ({})".format(f, error)
+                self.skipped[f] = error
+            elif len(song) > self.min_timesteps:
+                yield song
+
+    def __iter__(self):
+        items = self.songs()
+        if self.num_timesteps is not None:
+            items = (chunk for song in items for chunk in song.chunks(self.num_timesteps))
+        return shuffled(items, self.shuffle_buffer, self.rng)
+
+    def close(self):
+        """
+        Stops the stream's process pool, if it started one. The stream can still be iterated afterwards, which starts
+        a new pool.
+
+        :returns: None
+        :rtype: None
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,317 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import rbm
+import chunk_dataset
+import training_metrics
+
+
+# Settings of a trial that a sweep spec can vary, and their values when it does not
+defaults = {
+    "num_timesteps": rbm.num_timesteps,
+    "n_hidden": rbm.n_hidden,
+    "lr": rbm.lr,
+    "batch_size": rbm.batch_size,
+    "k": 1,
+}
+
+monitor_size = 500 # Largest number of training and of validation sections the trials are measured on
+
+
+def with_defaults(config):
+    """
+    Returns the settings of a trial: those of its configuration, and the default values of the others
+
+    :param config: settings varied by the sweep, by name
+    :type config: dict
+    :returns: every setting, by name
+    :rtype: dict
+    """
+    settings = dict(defaults)
+    settings.update((str(name), value) for name, value in config.items())
+    return settings
+
+
+def grid(spec):
+    """
+    Returns every combination of the values of a sweep spec.
+
+    :param spec: list of values to try for each setting, by name, e.g. {"n_hidden": [25, 50], "lr": [0.001, 0.005]}
+    :type spec: dict
+    :returns: one configuration per combination
+    :rtype: list of dict
+    """
+    names = sorted(spec)
+    return [dict(zip(names, values)) for values in itertools.product(*[spec[name] for name in names])]
+
+
+def random_search(spec, trials, seed=0):
+    """
+    Draws random configurations from a sweep spec. A list of values is sampled uniformly; a range
+    {"min": a, "max": b} is sampled uniformly, or log-uniformly with "log": true, and rounded when both ends are
+    integers.
+
+    :param spec: values or range to try for each setting, by name
+    :param trials: number of configurations
+    :param seed: seed of the random number generator, by default 0
+    :type spec: dict
+    :type trials: int
+    :type seed: int
+    :returns: configurations
+    :rtype: list of dict
+    """
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(trials):
+        config = {}
+        for name in sorted(spec):
+            values = spec[name]
+            if isinstance(values, dict):
+                low, high = values["min"], values["max"]
+                if values.get("log"):
+                    value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    value = float(rng.uniform(low, high))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = values[rng.randint(len(values))]
+            config[name] = value
+        configs.append(config)
+    return configs
+
+
+def dataset_dir(cache_dir, num_timesteps):
+    """
+    Returns the folder of the section dataset of a number of timesteps, training.py's for the default one
+
+    :param cache_dir: folder of the song cache
+    :param num_timesteps: number of timesteps per section
+    :type cache_dir: str
+    :type num_timesteps: int
+    :returns: folder of the dataset
+    :rtype: str
+    """
+    if num_timesteps == rbm.num_timesteps:
+        return os.path.join(cache_dir, "sections")
+    return os.path.join(cache_dir, "sections_{}".format(num_timesteps))
+
+
+def should_stop(history, trial, epoch, error, gap, settings):
+    """
+    Decides whether a trial is stopped after an epoch: when its validation reconstruction error is not finite or has
+    grown to more than 1.5 times its lowest value, when the free energy of the validation sections exceeds that of the training
+    sections by more than max_gap (overfitting), or, after grace_epochs, when its error is worse than the median of
+    the other trials at the same epoch (median stopping rule, once at least min_trials others got that far).
+
+    :param history: validation reconstruction errors of every trial by epoch, shared between the trials
+    :param trial: identifier of the trial
+    :param epoch: index of the epoch
+    :param error: validation reconstruction error of the trial
+    :param gap: free energy gap of the trial
+    :param settings: grace_epochs, max_gap and min_trials
+    :type history: dict
+    :type trial: int
+    :type epoch: int
+    :type error: float
+    :type gap: float
+    :type settings: dict
+    :returns: reason to stop, None to continue
+    :rtype: str
+    """
+    errors = history.get(trial, [])
+    if not np.isfinite(error) or (errors and error > 1.5*min(errors)):
+        return "diverged"
+    if settings["max_gap"] is not None and gap > settings["max_gap"]:
+        return "free energy gap {:.1f}".format(gap)
+    if epoch >= settings["grace_epochs"]:
+        others = [e[epoch] for t, e in history.items() if t != trial and len(e) > epoch]
+        if len(others) >= settings["min_trials"] and error > np.median(others):
+            return "worse than median"
+    return None
+
+
+def run_trial(job):
+    """
+    Trains an RBM with the NumPy engine on the training sections of a dataset for a configuration, and measures it
+    on the held-out sections after every epoch, stopping early when should_stop says so. Runs in a process of the
+    sweep's pool.
+
+    :param job: trial identifier, configuration, dataset folder, sweep settings and shared history
+    :type job: tuple
+    :returns: the configuration and the results of the trial
+    :rtype: dict
+    """
+    trial, config, directory, settings, history = job
+    start = time.time()
+    config = with_defaults(config)
+    dataset = chunk_dataset.ChunkDataset(directory)
+    train, validation = dataset.split(settings["validation_fraction"])
+    rng = np.random.RandomState(settings["seed"] + trial)
+    monitor_train = dataset.batch(rng.permutation(train)[:monitor_size])
+    monitor_validation = dataset.batch(rng.permutation(validation)[:monitor_size])
+    model = rbm.NumpyRBM.random(n_visible=dataset.n_visible, n_hidden=int(config["n_hidden"]),
+                                seed=settings["seed"] + trial)
+
+    result = {"trial": trial, "stopped": None}
+    errors = []
+    for epoch in range(settings["epochs"]):
+        for batch in dataset.batches(int(config["batch_size"]), rng, train):
+            model.train_batch(batch, int(config["k"]), config["lr"]*len(batch))
+        train_statistics = training_metrics.parameter_statistics(model, monitor_train)
+        statistics = training_metrics.parameter_statistics(model, monitor_validation)
+        gap = statistics["free_energy"] - train_statistics["free_energy"]
+        error = statistics["reconstruction_error"]
+        result.update({
+            "epochs": epoch + 1,
+            "validation_error": error,
+            "train_error": train_statistics["reconstruction_error"],
+            "free_energy_gap": gap,
+        })
+        reason = should_stop(history, trial, epoch, error, gap, settings)
+        errors.append(error)
+        history[trial] = errors
+        if reason is not None:
+            result["stopped"] = reason
+            break
+
+    result["seconds"] = time.time() - start
+    if settings["models_dir"] is not None:
+        model.save(os.path.join(settings["models_dir"], "trial_{}.npz".format(trial)))
+    result.update(config)
+    return result
+
+
+def run_sweep(configs, path="Midi_Files", cache_dir="song_cache", workers=None, epochs=20, validation_fraction=0.1,
+              grace_epochs=3, max_gap=None, min_trials=3, seed=0, models_dir=None):
+    """
+    Runs a trial per configuration (see run_trial) in a process pool, using every processor by default. The section
+    datasets the trials need are built beforehand, once per number of timesteps, and shared by every trial through
+    memory mapping.
+
+    :param configs: settings of each trial (see defaults)
+    :param path: folder of midi files and emotion text files, by default Midi_Files
+    :param cache_dir: folder of the song cache and section datasets, by default song_cache
+    :param workers: number of trials run at the same time, by default the number of processors
+    :param epochs: largest number of epochs per trial, by default 20
+    :param validation_fraction: fraction of the sections held out to measure the trials, by default 0.1
+    :param grace_epochs: number of epochs before the median stopping rule applies, by default 3
+    :param max_gap: largest free energy gap between validation and training sections, by default no limit
+    :param min_trials: number of other trials needed by the median stopping rule, by default 3
+    :param seed: seed of the trials, by default 0
+    :param models_dir: folder to save each trial's model to, by default models are not saved
+    :type configs: list of dict
+    :type path: str
+    :type cache_dir: str
+    :type workers: int
+    :type epochs: int
+    :type validation_fraction: float
+    :type grace_epochs: int
+    :type max_gap: float
+    :type min_trials: int
+    :type seed: int
+    :type models_dir: str
+    :returns: results of the trials, best first
+    :rtype: list of dict
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if models_dir is not None and not os.path.isdir(models_dir):
+        os.makedirs(models_dir)
+    directories = {}
+    for num_timesteps in sorted(set(int(with_defaults(c)["num_timesteps"]) for c in configs)):
+        directories[num_timesteps] = dataset_dir(cache_dir, num_timesteps)
+        chunk_dataset.load_chunk_dataset(path, directories[num_timesteps], num_timesteps, cache_dir, workers)
+
+    settings = {"epochs": epochs, "validation_fraction": validation_fraction, "grace_epochs": grace_epochs,
+                "max_gap": max_gap, "min_trials": min_trials, "seed": seed, "models_dir": models_dir}
+    manager = multiprocessing.Manager()
+    history = manager.dict()
+    jobs = [(trial, config, directories[int(with_defaults(config)["num_timesteps"])], settings, history)
+            for trial, config in enumerate(configs)]
+    pool = multiprocessing.Pool(workers)
+    results = []
+    try:
+        for result in pool.imap_unordered(run_trial, jobs):
+            print "trial {trial}: validation error {validation_error:.5f} after {epochs} epochs".format(**result) + (
+                " (stopped: {})".format(result["stopped"]) if result["stopped"] else "")
+            results.append(result)
+    finally:
+        pool.terminate()
+        manager.shutdown()
+    # trials that ran to the end first, then by validation reconstruction error
+    return sorted(results, key=lambda r: (r["stopped"] is not None, r["validation_error"]))
+
+
+def write_results(results, file_name):
+    """
+    Writes the results of a sweep as a csv table, one row per trial in the given order, with its rank.
+
+    :param results: results of the trials (see run_sweep)
+    :param file_name: path to the .csv file
+    :type results: list of dict
+    :type file_name: str
+    :returns: None
+    :rtype: None
+    """
+    columns = (["rank", "trial"] + sorted(defaults) +
+               ["epochs", "stopped", "validation_error", "train_error", "free_energy_gap", "seconds"])
+    with open(file_name, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for rank, result in enumerate(results):
+            writer.writerow([rank + 1] + [result.get(column, "") for column in columns[1:]])
+
+
+def main():
+    """
+    Runs a hyperparameter sweep of the RBM from a json spec, and writes and prints the ranked results.
+
+    This method is run through the command-line interface
+    :param spec: path to a json file holding the values (or ranges, with --random) to try for each setting
+    :returns: None
+    :rtype: None
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="Json file of the values to try, e.g. {\"n_hidden\": [25, 50, 100]}", type=str)
+    parser.add_argument("--random", help="Number of random configurations to draw instead of the full grid",
+                        type=int, default=None)
+    parser.add_argument("--path", help="Folder of midi files and emotion text files", type=str, default="Midi_Files")
+    parser.add_argument("--cache-dir", help="Folder of the song cache and section datasets", type=str,
+                        default="song_cache")
+    parser.add_argument("--workers", help="Number of trials run at the same time, by default one per processor",
+                        type=int, default=None)
+    parser.add_argument("--epochs", help="Largest number of epochs per trial", type=int, default=20)
+    parser.add_argument("--grace-epochs", help="Epochs before trials worse than the median are stopped", type=int,
+                        default=3)
+    parser.add_argument("--max-gap", help="Stop trials whose validation free energy exceeds the training free "
+                                          "energy by more than this", type=float, default=None)
+    parser.add_argument("--seed", help="Seed of the random search and of the trials", type=int, default=0)
+    parser.add_argument("--models-dir", help="Folder to save each trial's model to", type=str, default=None)
+    parser.add_argument("--output", help="Ranked results table", type=str, default="sweep_results.csv")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    unknown = set(spec) - set(defaults)
+    if unknown:
+        parser.error("unknown settings {}, expected some of {}".format(sorted(unknown), sorted(defaults)))
+    configs = grid(spec) if args.random is None else random_search(spec, args.random, args.seed)
+    print "{} trials".format(len(configs))
+
+    results = run_sweep(configs, args.path, args.cache_dir, args.workers, args.epochs, grace_epochs=args.grace_epochs,
+                        max_gap=args.max_gap, seed=args.seed, models_dir=args.models_dir)
+    write_results(results, args.output)
+    print "{:>4} {}".format("rank", "validation error, settings")
+    for rank, result in enumerate(results):
+        print "{:>4} {:.5f} {}{}".format(rank + 1, result["validation_error"],
+                                         ", ".join("{}={}".format(name, result[name]) for name in sorted(defaults)),
+                                         " (stopped: {})".format(result["stopped"]) if result["stopped"] else "")
+    print "Results written to {}".format(args.output)
+
+if __name__ == "__main__":
+    main()
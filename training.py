@@ -1,19 +1,91 @@
 # Code based on Dan Shiebler's RBM music generator: https://github.com/dshieble/Music_RBM
 
+import argparse
 import tensorflow as tf
 import numpy as np
 import rbm
-import midi_manipulation
+import chunk_dataset
+import multiprocessing
+import time
+import training_metrics
+import run_state
+import shutil
 from tensorflow.python.ops import control_flow_ops
 from tqdm import tqdm
 
 
 epochs_to_save = 5 # Number of epochs to run between saving each checkpoint
+metrics_every = 50 # Number of updates between each record of the training metrics
+monitor_size = 200 # Number of sections the model is measured on at the end of each epoch
+validation_size = 500 # Largest number of held-out sections the model is validated on
+checkpoint_dir = "parameter_checkpoints"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", help="Checkpoint to continue training from, by default the latest epoch checkpoint",
+                    type=str, nargs="?", const="latest", default=None)
+parser.add_argument("--seed", help="Seed of the order of the training data and of sampling, by default random",
+                    type=int, default=None)
+parser.add_argument("--keep-last", help="Number of most recent epoch checkpoints kept", type=int, default=3)
+parser.add_argument("--keep-every", help="Epoch checkpoints of every this many epochs are kept as well",
+                    type=int, default=25)
+parser.add_argument("--validation-fraction", help="Fraction of the sections (whole songs) held out for validation",
+                    type=float, default=0.1)
+parser.add_argument("--validate-every", help="Number of epochs between validations", type=int, default=1)
+parser.add_argument("--patience", help="Stop after this many validations without improvement", type=int,
+                    default=training_metrics.default_patience)
+parser.add_argument("--min-delta", help="Smallest decrease of the validation error counted as an improvement",
+                    type=float, default=0.0)
+parser.add_argument("--max-gap", help="Stop once the held-out free energy exceeds the training free energy by more "
+                                      "than this", type=float, default=None)
+parser.add_argument("--prefetch", help="Number of batches prepared in the background while updates run, 0 to prepare "
+                                       "each batch between updates", type=int, default=4)
+parser.add_argument("--data-workers", help="Number of threads preparing batches", type=int, default=1)
+parser.add_argument("--max-shift", help="Largest number of semitones training sections are randomly transposed by",
+                    type=int, default=0)
+args = parser.parse_args()
 
 num_timesteps = rbm.num_timesteps
-x, emotions, W, bh, bv = rbm.get_variables()
+hyperparameters = {
+    "lr": rbm.lr,
+    "batch_size": rbm.batch_size,
+    "num_epochs": rbm.num_epochs,
+    "num_timesteps": num_timesteps,
+    "n_hidden": rbm.n_hidden,
+    "seed": args.seed if args.seed is not None else np.random.randint(2**31 - 1),
+    "validation_fraction": args.validation_fraction,
+    "validate_every": args.validate_every,
+    "patience": args.patience,
+    "min_delta": args.min_delta,
+    "max_gap": args.max_gap,
+    "max_shift": args.max_shift,
+}
+
+# A resumed run continues with the weights, epoch, data order, hyperparameters and validation history saved with the
+# checkpoint
+start_epoch = 0
+checkpoint = None
+progress = {}
+if args.resume is not None:
+    checkpoint = run_state.latest_checkpoint(checkpoint_dir) if args.resume == "latest" else args.resume
+    if checkpoint is None:
+        raise ValueError("{} holds no checkpoint to resume from".format(checkpoint_dir))
+    start_epoch, rng, saved = run_state.load_run_state(checkpoint)
+    if (saved["num_timesteps"], saved["n_hidden"]) != (num_timesteps, rbm.n_hidden):
+        raise ValueError("{} was trained with {} timesteps and {} hidden nodes".format(
+            checkpoint, saved["num_timesteps"], saved["n_hidden"]))
+    hyperparameters.update(saved)
+    progress = run_state.load_progress(checkpoint)
+    print "Resuming from {} after {} epochs".format(checkpoint, start_epoch)
+else:
+    rng = np.random.RandomState(hyperparameters["seed"])
+
+rbm.lr = hyperparameters["lr"] # read by rbm.batch_lr
 lr = rbm.lr           # learning rate
-num_epochs = rbm.num_epochs
+num_epochs = hyperparameters["num_epochs"]
+batch_size = hyperparameters["batch_size"]
+# TensorFlow's random state cannot be saved, so a resumed run seeds sampling differently from the epochs before it
+tf.set_random_seed(hyperparameters["seed"] + start_epoch)
+x, emotions, W, bh, bv = rbm.get_variables()
 
 def sample(probs):
     """
@@ -69,40 +141,105 @@ h = sample(tf.sigmoid(tf.matmul(x, W) + bh))
 h_sample = sample(tf.sigmoid(tf.matmul(x_sample, W) + bh)) 
 
 # update the values of W, bh, and bv, based on the difference between the samples that we drew and the original values
+# x holds a batch of examples, one per row, so each update is a single matrix-matrix product averaged over the batch
 size_bt = tf.cast(tf.shape(x)[0], tf.float32)
-W_adder  = tf.mul(lr/size_bt, tf.sub(tf.matmul(tf.transpose(x), h), tf.matmul(tf.transpose(x_sample), h_sample)))
-bv_adder = tf.mul(lr/size_bt, tf.reduce_sum(tf.sub(x, x_sample), 0, True))
-bh_adder = tf.mul(lr/size_bt, tf.reduce_sum(tf.sub(h, h_sample), 0, True))
+lr_bt = rbm.batch_lr(size_bt)
+W_adder  = tf.mul(lr_bt/size_bt, tf.sub(tf.matmul(tf.transpose(x), h), tf.matmul(tf.transpose(x_sample), h_sample)))
+bv_adder = tf.mul(lr_bt/size_bt, tf.reduce_sum(tf.sub(x, x_sample), 0, True))
+bh_adder = tf.mul(lr_bt/size_bt, tf.reduce_sum(tf.sub(h, h_sample), 0, True))
 # When we call sess.run(updt), TensorFlow will run the following 3 update steps
 updt = [W.assign_add(W_adder), bv.assign_add(bv_adder), bh.assign_add(bh_adder)]
-
-songs = midi_manipulation.get_songs('Midi_Files')       # list of songs in matrix form
-print "{} songs processed".format(len(songs))
-
-saver = tf.train.Saver(max_to_keep=None) 
+# Mean squared difference between the batch and its reconstruction, computed from x_sample along with the update
+reconstruction_error = tf.reduce_mean(tf.square(tf.sub(x, x_sample)))
+
+# The songs are stored in a time x notes format. The size of each song is total_timesteps x 2*note_range+2.
+# Each song is split once into sections of 64 timesteps, so that each training example is a vector with
+# num_timesteps x 2*note_range+2. The sections are kept in a memory-mapped dataset, rebuilt only when the songs change
+sub_songs = chunk_dataset.load_chunk_dataset('Midi_Files', 'song_cache/sections', num_timesteps,
+                                             cache_dir='song_cache', workers=multiprocessing.cpu_count())
+print "{} sections of {} timesteps".format(len(sub_songs), num_timesteps)
+# Whole songs are held out to validate the model, always the same ones for a given fraction
+train_sections, validation_sections = sub_songs.split(hyperparameters["validation_fraction"])
+print "{} sections held out for validation".format(len(validation_sections))
+# The same sections are used to measure the model at the end of every epoch, so the values can be compared
+monitor = sub_songs.batch(np.random.RandomState(0).permutation(train_sections)[:monitor_size])
+validation = sub_songs.batch(np.random.RandomState(0).permutation(validation_sections)[:validation_size])
+# as many training sections as held-out ones, for the free energy gap
+train_sample = sub_songs.batch(np.random.RandomState(0).permutation(train_sections)[:len(validation)])
+early_stopping = training_metrics.EarlyStopping(hyperparameters["patience"], hyperparameters["min_delta"],
+                                                hyperparameters["max_gap"], progress.get("early_stopping"))
+
+# Throughput, time spent waiting for batches and running updates, and the state of the model, as json lines
+# (see training_metrics.MetricsLogger)
+metrics = training_metrics.MetricsLogger("{}/training_metrics.jsonl".format(checkpoint_dir), metrics_every,
+                                         'w' if checkpoint is None else 'a')
+metrics.start(sections=len(sub_songs), num_timesteps=num_timesteps, n_visible=sub_songs.n_visible,
+              batch_size=batch_size, num_epochs=num_epochs, lr=lr, start_epoch=start_epoch, prefetch=args.prefetch,
+              data_workers=args.data_workers, max_shift=hyperparameters["max_shift"])
+
+# TensorFlow keeps every checkpoint, old epoch checkpoints are deleted by run_state.prune_checkpoints instead,
+# which keeps the most recent ones and those of every keep_every epochs
+saver = tf.train.Saver(max_to_keep=None)
 
 with tf.Session() as sess:
     # initialize the variables of the model
     init = tf.initialize_all_variables()
     sess.run(init)
+    if checkpoint is not None:
+        saver.restore(sess, checkpoint)
+    completed = start_epoch
     # Run through all of the training data num_epochs times
-    for epoch in tqdm(range(num_epochs)):
-        for song in songs:
-            # The songs are stored in a time x notes format. The size of each song is total_timesteps x 2*note_range+2
-            # reshape the songs so that each training example is a vector with num_timesteps x 2*note_range+2
-            song = np.array(song)
-            rows = song.shape[0]/(num_timesteps)
-            song = song[:rows*num_timesteps]
-            
-            # split songs into smaller sections of 64 timesteps
-            song = np.reshape(song, [rows, song.shape[1]*(num_timesteps)])
-            sub_songs = np.vsplit(song, rows)
-
-            for s in sub_songs:
-                sess.run(updt, feed_dict={x: s})
-
-        # Save the weights and biases of the model every few epochs
-        if (epoch + 1) % epochs_to_save == 0:
-            saver.save(sess, "parameter_checkpoints/epoch", global_step=epoch)
-
-    save_path = saver.save(sess, "parameter_checkpoints/trained_system")        
+    for epoch in tqdm(range(start_epoch, num_epochs)):
+        # go through the sections in a new random order, batch_size x n_visible at a time. The next batches are
+        # expanded by background threads while sess.run updates the model, so the time measured by metrics.timed is
+        # only what the updates still wait for
+        batches = sub_songs.prefetched_batches(batch_size, rng, train_sections, args.prefetch, args.data_workers,
+                                               hyperparameters["max_shift"])
+        for batch in metrics.timed(batches):
+            start = time.time()
+            _, error = sess.run([updt, reconstruction_error], feed_dict={x: batch})
+            metrics.update(len(batch), time.time() - start, error)
+        model = rbm.NumpyRBM(*sess.run([W, bh, bv]))
+        metrics.epoch(epoch, model, monitor)
+        completed = epoch + 1
+
+        # Measure the model on the held-out songs, keep the best one so far and stop once it no longer improves
+        stop = None
+        if completed % hyperparameters["validate_every"] == 0 and len(validation):
+            statistics = training_metrics.validation_statistics(model, train_sample, validation)
+            improved, stop = early_stopping.update(epoch, statistics["validation_reconstruction_error"],
+                                                   statistics["free_energy_gap"])
+            metrics.validation(epoch, statistics, early_stopping.best_epoch)
+            if improved:
+                # named after its epoch, so a run resumed from an earlier checkpoint never restores the best model
+                # of the run it abandoned
+                early_stopping.best_checkpoint = saver.save(sess, "{}/best".format(checkpoint_dir), global_step=epoch)
+                run_state.save_run_state(early_stopping.best_checkpoint, completed, rng, hyperparameters,
+                                         {"early_stopping": early_stopping.state()})
+                run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint)
+
+        # Save the weights and biases of the model every few epochs, with the state needed to resume from them
+        if completed % epochs_to_save == 0 or stop is not None:
+            checkpoint_path = saver.save(sess, "{}/epoch".format(checkpoint_dir), global_step=epoch)
+            run_state.save_run_state(checkpoint_path, completed, rng, hyperparameters,
+                                     {"early_stopping": early_stopping.state()})
+            run_state.prune_checkpoints(checkpoint_dir, args.keep_last, args.keep_every)
+            if early_stopping.best_checkpoint is not None:
+                run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint)
+        if stop is not None:
+            print "Stopped after {} epochs: {}".format(completed, stop)
+            break
+
+    # The trained system is the model of the best validation
+    if early_stopping.best_checkpoint is not None:
+        print "Best validation after {} epochs".format(early_stopping.best_epoch + 1)
+        saver.restore(sess, early_stopping.best_checkpoint)
+        run_state.prune_best_checkpoints(checkpoint_dir, early_stopping.best_checkpoint)
+    save_path = saver.save(sess, "{}/trained_system".format(checkpoint_dir))
+    if early_stopping.best_checkpoint is not None:
+        # the run state of the weights saved, those of the best epoch rather than of the last one
+        shutil.copyfile(run_state.state_file(early_stopping.best_checkpoint), run_state.state_file(save_path))
+    else:
+        run_state.save_run_state(save_path, completed, rng, hyperparameters,
+                                 {"early_stopping": early_stopping.state()})
+    metrics.close()
@@ -0,0 +1,314 @@
+import json
+import multiprocessing
+import platform
+import time
+import numpy as np
+
+default_patience = 10 # Number of validations without improvement before training stops, unless set otherwise
+
+
+def parameter_statistics(model, x):
+    """
+    Measures how well an RBM models a fixed set of examples and summarises its parameters: the mean squared
+    difference between the examples and their reconstruction after one Gibbs step, the mean free energy of the
+    examples, and the norms and spread of the weights and biases.
+
+    :param model: RBM to measure
+    :param x: examples, one row per example, the same ones every time so values can be compared between epochs
+    :type model: rbm.NumpyRBM
+    :type x: numpy array
+    :returns: statistics by name
+    :rtype: dict
+    """
+    x = np.asarray(x, dtype=np.float32)
+    reconstruction = model.gibbs_sample(x, 1)
+    return {
+        "reconstruction_error": float(np.mean(np.square(x - reconstruction))),
+        "free_energy": float(model.free_energy(x).mean()),
+        "W_norm": float(np.linalg.norm(model.W)),
+        "W_mean": float(model.W.mean()),
+        "W_std": float(model.W.std()),
+        "W_max_abs": float(np.abs(model.W).max()),
+        "bh_norm": float(np.linalg.norm(model.bh)),
+        "bv_norm": float(np.linalg.norm(model.bv)),
+    }
+
+
+def validation_statistics(model, train_x, validation_x):
+    """
+    Measures an RBM on held-out examples: their one-step reconstruction error and mean free energy, and the free
+    energy gap, the mean free energy of the held-out examples minus that of as many training examples. The free
+    energy of a single set cannot be compared between epochs, as the partition function changes, but the gap can:
+    it grows as the model starts fitting the training examples better than the held-out ones.
+
+    :param model: RBM to measure
+    :param train_x: training examples, one row per example, at least as many as validation_x
+    :param validation_x: held-out examples, one row per example
+    :type model: rbm.NumpyRBM
+    :type train_x: numpy array
+    :type validation_x: numpy array
+    :returns: statistics by name
+    :rtype: dict
+    """
+    validation_x = np.asarray(validation_x, dtype=np.float32)
+    validation_free_energy = float(model.free_energy(validation_x).mean())
+    train_free_energy = float(model.free_energy(train_x[:len(validation_x)]).mean())
+    return {
+        "validation_reconstruction_error": float(np.mean(np.square(validation_x -
+                                                                   model.gibbs_sample(validation_x, 1)))),
+        "validation_free_energy": validation_free_energy,
+        "train_free_energy": train_free_energy,
+        "free_energy_gap": validation_free_energy - train_free_energy,
+    }
+
+
+class EarlyStopping(object):
+    """
+    Tracks the validation reconstruction error of a training run (see validation_statistics) and decides when to
+    stop: after patience validations in a row without improving on the best error by more than min_delta, or as soon
+    as the free energy gap exceeds max_gap. The caller saves the best model and records where in best_checkpoint,
+    which is kept with the state so that a resumed run restores the model of its own best epoch.
+    """
+
+    def __init__(self, patience=default_patience, min_delta=0.0, max_gap=None, state=None):
+        """
+        :param patience: number of validations without improvement before stopping, by default default_patience (10)
+        :param min_delta: smallest decrease of the error counted as an improvement, by default 0
+        :param max_gap: largest free energy gap, by default no limit
+        :param state: state of a previous run to continue from (see state), by default none
+        :type patience: int
+        :type min_delta: float
+        :type max_gap: float
+        :type state: dict
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_gap = max_gap
+        self.best = None
+        self.best_epoch = None
+        self.validations_without_improvement = 0
+        self.best_checkpoint = None
+        if state:
+            self.best = state["best"]
+            self.best_epoch = state["best_epoch"]
+            self.validations_without_improvement = state["validations_without_improvement"]
+            self.best_checkpoint = state.get("best_checkpoint")
+
+    def update(self, epoch, error, gap):
+        """
+        Records a validation.
+
+        :param epoch: index of the epoch
+        :param error: validation reconstruction error
+        :param gap: free energy gap
+        :type epoch: int
+        :type error: float
+        :type gap: float
+        :returns: whether the error is the best so far, and the reason to stop (None to continue)
+        :rtype: tuple
+        """
+        improved = self.best is None or error < self.best - self.min_delta
+        if improved:
+            self.best = error
+            self.best_epoch = epoch
+            self.validations_without_improvement = 0
+        else:
+            self.validations_without_improvement += 1
+
+        if self.max_gap is not None and gap > self.max_gap:
+            return improved, "free energy gap {:.2f} above {}".format(gap, self.max_gap)
+        if self.validations_without_improvement >= self.patience:
+            return improved, "no improvement in {} validations".format(self.patience)
+        return improved, None
+
+    def state(self):
+        """
+        :returns: what is needed to continue tracking after resuming a run
+        :rtype: dict
+        """
+        return {"best": self.best, "best_epoch": self.best_epoch,
+                "validations_without_improvement": self.validations_without_improvement,
+                "best_checkpoint": self.best_checkpoint}
+
+
+class MetricsLogger(object):
+    """
+    Writes training metrics as json lines, one record per line with a "type" field:
+
+    * "start": the dataset and hardware the run uses
+    * "updates": every `every` updates, the number of examples per second and the seconds spent waiting for batches
+      (data) and running updates (run) since the last record, and the mean reconstruction error of those batches
+      (null if none was measured)
+    * "epoch": the same totals over the epoch, and the statistics of the model (see parameter_statistics)
+    * "validation": the statistics of the model on held-out examples (see validation_statistics)
+
+    A data fraction close to 1 means the run waits on its input pipeline; close to 0, on the updates themselves.
+    """
+
+    def __init__(self, file_name, every=50, mode='w'):
+        """
+        :param file_name: path to the .jsonl file
+        :param every: number of updates between "updates" records, by default 50
+        :param mode: 'w' to start a new file, 'a' to append to it, by default 'w'
+        :type file_name: str
+        :type every: int
+        :type mode: str
+        """
+        self.f = open(file_name, mode)
+        self.every = every
+        self.updates = 0
+        self.window = self.new_totals()
+        self.totals = self.new_totals()
+        self.wait_start = None
+        self.data_seconds = 0.0
+
+    @staticmethod
+    def new_totals():
+        return {"updates": 0, "examples": 0, "data_seconds": 0.0, "run_seconds": 0.0, "error": 0.0, "errors": 0,
+                "start": time.time()}
+
+    def write(self, record):
+        """
+        Writes a record as one json line and flushes it, so the file can be read while training runs.
+
+        :param record: metrics by name
+        :type record: dict
+        :returns: None
+        :rtype: None
+        """
+        record["time"] = time.time()
+        self.f.write(json.dumps(record, sort_keys=True) + "\n")
+        self.f.flush()
+
+    def start(self, **info):
+        """
+        Writes the "start" record: the given values (e.g. number of sections, batch size) and the machine's processor
+        count and platform.
+
+        :returns: None
+        :rtype: None
+        """
+        record = {"type": "start", "cpu_count": multiprocessing.cpu_count(), "platform": platform.platform()}
+        record.update(info)
+        self.write(record)
+
+    def timed(self, batches):
+        """
+        Yields the batches of an iterable, timing how long each takes to arrive. The time is counted as data time by
+        the next call to update.
+
+        :param batches: batches of examples
+        :type batches: iterable
+        :returns: generator over the batches
+        :rtype: generator
+        """
+        batches = iter(batches)
+        while True:
+            self.wait_start = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.data_seconds = time.time() - self.wait_start
+            yield batch
+
+    def update(self, examples, run_seconds, error=None, data_seconds=None):
+        """
+        Records an update, and writes an "updates" record every `every` updates.
+
+        :param examples: number of examples in the batch
+        :param run_seconds: seconds spent running the update
+        :param error: mean squared reconstruction error of the batch, if measured
+        :param data_seconds: seconds spent preparing the batch, by default the time measured by timed
+        :type examples: int
+        :type run_seconds: float
+        :type error: float
+        :type data_seconds: float
+        :returns: None
+        :rtype: None
+        """
+        if data_seconds is None:
+            data_seconds = self.data_seconds if self.wait_start is not None else 0.0
+        self.wait_start = None
+        for totals in (self.window, self.totals):
+            totals["updates"] += 1
+            totals["examples"] += examples
+            totals["data_seconds"] += data_seconds
+            totals["run_seconds"] += run_seconds
+            if error is not None:
+                totals["error"] += float(error)
+                totals["errors"] += 1
+        self.updates += 1
+        if self.updates % self.every == 0:
+            self.write(self.summary("updates", self.window))
+            self.window = self.new_totals()
+
+    def summary(self, record_type, totals):
+        seconds = time.time() - totals["start"]
+        busy = totals["data_seconds"] + totals["run_seconds"]
+        return {
+            "type": record_type,
+            "update": self.updates,
+            "updates": totals["updates"],
+            "examples": totals["examples"],
+            "seconds": seconds,
+            "examples_per_second": totals["examples"]/seconds if seconds > 0 else None,
+            "data_seconds": totals["data_seconds"],
+            "run_seconds": totals["run_seconds"],
+            "data_fraction": totals["data_seconds"]/busy if busy > 0 else None,
+            "batch_reconstruction_error": totals["error"]/totals["errors"] if totals["errors"] else None,
+        }
+
+    def epoch(self, epoch, model=None, x=None):
+        """
+        Writes the "epoch" record for the updates since the last one, with the statistics of the model on the
+        examples x if given.
+
+        :param epoch: index of the epoch
+        :param model: RBM at the end of the epoch
+        :param x: examples to measure the model on (see parameter_statistics)
+        :type epoch: int
+        :type model: rbm.NumpyRBM
+        :type x: numpy array
+        :returns: None
+        :rtype: None
+        """
+        record = self.summary("epoch", self.totals)
+        record["epoch"] = epoch
+        if model is not None:
+            record.update(parameter_statistics(model, x))
+        self.write(record)
+        self.totals = self.new_totals()
+
+    def validation(self, epoch, statistics, best_epoch):
+        """
+        Writes a "validation" record.
+
+        :param epoch: index of the epoch
+        :param statistics: statistics of the model on held-out examples (see validation_statistics)
+        :param best_epoch: epoch of the best validation so far
+        :type epoch: int
+        :type statistics: dict
+        :type best_epoch: int
+        :returns: None
+        :rtype: None
+        """
+        record = {"type": "validation", "epoch": epoch, "best_epoch": best_epoch}
+        record.update(statistics)
+        self.write(record)
+
+    def close(self):
+        self.f.close()
+
+
+def read_metrics(file_name):
+    """
+    Reads the records written by a MetricsLogger
+
+    :param file_name: path to the .jsonl file
+    :type file_name: str
+    :returns: records, in the order they were written
+    :rtype: list of dict
+    """
+    with open(file_name) as f:
+        return [json.loads(line) for line in f if line.strip()]